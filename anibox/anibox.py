@@ -1,7 +1,11 @@
 import tkinter as tk
 from PIL import Image, ImageTk
+import asyncio
 import time
 import os
+import bisect
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
 
 mpath = os.path.dirname(__file__)
 
@@ -10,43 +14,13 @@ class TilesetDimensionsError(Exception):
 		message = "This tileset is not formatted properly: %r" % tileset
 		super(TilesetDimensionsError, self).__init__(message)
 
-        
-class Anibox(tk.Frame):
-	def __init__(self, master, cnf={}, **kw):
-		# Setup Anibox spefic attributes
-		self.tile_dimensions = [36,36]
-		self.placeholder = mpath + '\example2.png'
-		sizemult = kw.pop('sizemult', 1)
-		self.tileset = kw.pop('tileset', 'no image')
-		self.tiles = self._getTiles(self.tileset, sizemult)
-		self.speed = int(kw.pop('speed', 0.5) * 1000)
-		self.updatetime = time.time()
-		self.curindex = 0
-		
-		# container background
-		tsbg = kw.pop('tbg', 'lightgrey') 
-		
-		# Call to Frame.__init__() must happen before creating container
-		tk.Frame.__init__(self, master, cnf, **kw)
-		self.container = tk.Label(self, image=self.tiles[0], border=0, bg=tsbg)
-		self.container.pack()
-		self.pos = self.getPos()
+def sliceTileset(path, dimensions, sizemult):
+	"""The tiles of tileset path scaled by sizemult, as PIL images. Doesn't
+	touch Tk, so it can run in any thread."""
+	dimx = dimensions[0] * sizemult
+	dimy = dimensions[1] * sizemult
 	
-		# FPS tracking
-		self.updatetime_prev = None
-		
-	def _getTiles(self, path, sizemult):
-		tiles = []
-		dimx = self.tile_dimensions[0] * sizemult
-		dimy = self.tile_dimensions[1] * sizemult
-		
-		try:
-			tileset = Image.open(path)
-		except FileNotFoundError:
-			path = self.placeholder
-			tileset = Image.open(path)
-		self.tileset = path
-		
+	with Image.open(path) as tileset:
 		w, h = tileset.size
 		
 		# Get number of tiles in set if tileset is formatted properly
@@ -56,23 +30,304 @@ class Anibox(tk.Frame):
 			raise TilesetDimensionsError(tileset)
 			
 		tileset = tileset.resize((w*sizemult, h*sizemult))
+	
+	tiles = []
+	for i in range(n):
+		x1 = i * dimx
+		x2 = i * dimx + dimx
+		tiles.append(tileset.crop((x1, 0, x2, dimy)))
+	return tiles
+
+
+class Atlas(object):
+	"""The frames of one tileset at one size, sliced once and shared by
+	every Anibox showing it. Indexes like the list of frames."""
+	def __init__(self, path, dimensions, sizemult, tiles=None):
+		if tiles is None:
+			tiles = sliceTileset(path, dimensions, sizemult)
+		self.frames = [ImageTk.PhotoImage(tile) for tile in tiles]
+		self.pixels = len(tiles) * dimensions[0] * dimensions[1] * sizemult**2
+	
+	def __len__(self):
+		return len(self.frames)
+	
+	def __getitem__(self, i):
+		return self.frames[i]
+
+
+class LazyAtlas(object):
+	"""The unscaled sheet of a tileset, for tilesets too long or heavily
+	scaled to hold every frame of. Frames are scaled one at a time when
+	they're needed, by the LazyFrames of each Anibox showing it."""
+	def __init__(self, path, dimensions, sizemult):
+		self.dimx = dimensions[0] * sizemult
+		self.dimy = dimensions[1] * sizemult
 		
-		for i in range(n):
-			x1 = i * dimx
-			x2 = i * dimx + dimx
-			tile = tileset.crop((x1, 0, x2, dimy))
-			tiles.append(ImageTk.PhotoImage(tile))
+		tileset = Image.open(path)
+		w, h = tileset.size
+		
+		# Get number of tiles in set if tileset is formatted properly
+		if h*sizemult == self.dimy and w*sizemult % self.dimx == 0:
+			self.n = w*sizemult // self.dimx
+		else:
+			tileset.close()
+			raise TilesetDimensionsError(tileset)
 		
+		tileset.load()
+		self.tileset = tileset
+		self.tile = (w // self.n, h)
+		self.pixels = w * h
+	
+	def __len__(self):
+		return self.n
+	
+	def scale(self, i):
+		"""Frame i as a PIL image. Doesn't touch Tk, so it can run in
+		any thread."""
+		w, h = self.tile
+		tile = self.tileset.crop((i * w, 0, i * w + w, h))
+		return tile.resize((self.dimx, self.dimy))
+
+
+class LazyFrames(object):
+	"""The frames of a LazyAtlas for one Anibox or Sprite, indexing like an
+	Atlas. A frame becomes a PhotoImage when first shown, while the next
+	prefetch frames are scaled in loader's threads. Only the window most
+	recently shown are kept, and each user has its own, so sprites at
+	different points of one tileset don't evict each other's frames."""
+	def __init__(self, atlas, window=8, prefetch=2):
+		self.atlas = atlas
+		self.window = max(window, prefetch + 1)
+		self.prefetch = prefetch
+		self.frames = OrderedDict()
+		self.pending = {}
+	
+	def __len__(self):
+		return len(self.atlas)
+	
+	def __getitem__(self, i):
+		n = len(self.atlas)
+		i = range(n)[i]
+		frame = self.frames.get(i)
+		if frame is not None:
+			self.frames.move_to_end(i)
+		else:
+			work = self.pending.pop(i, None)
+			if work is not None and work.done() and not work.exception():
+				tile = work.result()
+			else:
+				# Not prefetched in time
+				if work is not None:
+					work.cancel()
+				tile = self.atlas.scale(i)
+			frame = self.frames[i] = ImageTk.PhotoImage(tile)
+			while len(self.frames) > self.window:
+				self.frames.popitem(last=False)
+		
+		for j in list(self.pending):
+			if (j - i) % n > self.prefetch:
+				# Skipped over
+				self.pending.pop(j).cancel()
+		for j in range(i + 1, i + self.prefetch + 1):
+			j %= n
+			if j not in self.frames and j not in self.pending:
+				self.pending[j] = loader.submit(self.atlas.scale, j)
+		return frame
+
+
+class AtlasCache(object):
+	"""Atlases by (path, tile dimensions, sizemult, mtime), so a tileset is
+	only decoded again once its file changes. The least recently used ones
+	are dropped once together they hold more than maxpixels pixels (about
+	four bytes each as PhotoImages); Aniboxes still showing them keep theirs."""
+	def __init__(self, maxpixels=2**24):
+		self.maxpixels = maxpixels
+		self.pixels = 0
+		self.atlases = OrderedDict()
+	
+	def _key(self, path, dimensions, sizemult, lazy):
+		mtime = os.stat(path).st_mtime_ns
+		return (os.path.abspath(path), tuple(dimensions), sizemult, mtime,
+			bool(lazy))
+	
+	def _cached(self, key):
+		atlas = self.atlases.get(key)
+		if atlas is not None:
+			self.atlases.move_to_end(key)
+		return atlas
+	
+	def _add(self, key, atlas):
+		self.atlases[key] = atlas
+		self.pixels += atlas.pixels
+		while self.pixels > self.maxpixels and len(self.atlases) > 1:
+			old = self.atlases.popitem(last=False)[1]
+			self.pixels -= old.pixels
+	
+	def get(self, path, dimensions, sizemult, lazy=False):
+		"""The Atlas of tileset path, or with lazy its LazyAtlas."""
+		key = self._key(path, dimensions, sizemult, lazy)
+		atlas = self._cached(key)
+		if atlas is None:
+			if lazy:
+				atlas = LazyAtlas(path, dimensions, sizemult)
+			else:
+				atlas = Atlas(path, dimensions, sizemult)
+			self._add(key, atlas)
+		return atlas
+	
+	def load(self, widget, path, dimensions, sizemult, placeholder,
+			lazy=False):
+		"""get() with the PIL work done in a worker thread, for tilesets
+		big enough to freeze the UI. Returns a Future of (path, atlas) as
+		for getTiles(), set from widget's Tk thread once the PhotoImages
+		are made there."""
+		done = Future()
+		try:
+			key = self._key(path, dimensions, sizemult, lazy)
+		except FileNotFoundError:
+			path = placeholder
+			key = self._key(path, dimensions, sizemult, lazy)
+		atlas = self._cached(key)
+		if atlas is not None:
+			done.set_result((path, atlas))
+			return done
+		
+		if lazy:
+			# Only opens the unscaled sheet, no Tk involved
+			work = loader.submit(LazyAtlas, path, dimensions, sizemult)
+		else:
+			work = loader.submit(sliceTileset, path, dimensions, sizemult)
+		
+		def poll():
+			# Tk may only be used from its own thread, so check back
+			# rather than having the worker call in
+			if not work.done():
+				widget.after(20, poll)
+				return
+			try:
+				if lazy:
+					atlas = work.result()
+				else:
+					atlas = Atlas(path, dimensions, sizemult, work.result())
+			except Exception as e:
+				done.set_exception(e)
+				return
+			self._add(key, atlas)
+			done.set_result((path, atlas))
+		widget.after(20, poll)
+		return done
+	
+	def clear(self):
+		self.atlases.clear()
+		self.pixels = 0
+
+# Shared by every Anibox in the process
+atlases = AtlasCache()
+loader = ThreadPoolExecutor(2, 'anibox')
+
+
+def getTiles(path, dimensions, sizemult, placeholder, lazy=0):
+	"""The path used and the frames of tileset path, or of placeholder if
+	there is no such file. With lazy they're LazyFrames of their own,
+	keeping that many frames (8 for True)."""
+	try:
+		atlas = atlases.get(path, dimensions, sizemult, lazy)
+	except FileNotFoundError:
+		path = placeholder
+		atlas = atlases.get(path, dimensions, sizemult, lazy)
+	return path, lazyFrames(atlas, lazy)
+
+
+def lazyFrames(atlas, lazy):
+	"""atlas as a user of it should index it: LazyFrames of its own
+	keeping lazy frames (8 for True) for a LazyAtlas."""
+	if not lazy:
+		return atlas
+	if lazy is True:
+		lazy = 8
+	return LazyFrames(atlas, lazy)
+
+        
+class Animation(object):
+	"""What Anibox and Sprite share: a tileset cut into frames, the one
+	shown and the speed they change at. Subclasses draw frame i in
+	_show(i)."""
+	def _setAnimation(self, kw):
+		# Takes the animation options out of kw, returning sizemult
+		self.tile_dimensions = [36,36]
+		self.placeholder = os.path.join(mpath, 'example2.png')
+		sizemult = kw.pop('sizemult', 1)
+		# Frames kept decoded, or all of them
+		self.lazy = kw.pop('lazy', 0)
+		self.tileset = kw.pop('tileset', 'no image')
+		self.speed = int(kw.pop('speed', 0.5) * 1000)
+		self.curindex = 0
+		return sizemult
+	
+	def _getTiles(self, path, sizemult):
+		self.tileset, tiles = getTiles(path, self.tile_dimensions, sizemult,
+			self.placeholder, self.lazy)
 		return tiles
 	
 	def resize(self, sizemult):
 		self.tiles = self._getTiles(self.tileset, sizemult)
-		self.container.config(image=self.tiles[0])
+		self._show(0)
 	
 	def changespeed(self, speed):
 		if speed < 0.001:
 			return False
 		self.speed = int(speed * 1000)
+	
+	def newTileset(self, path, **kw):
+	
+		speed = kw.pop('speed', self.speed)
+		sizemult = kw.pop('sizemult', 1)
+		self.tiles = self._getTiles(path, sizemult)
+		self.curindex = 0
+		self._show(0)
+		self.speed = speed
+	
+	def advance(self, steps=1):
+		"""Move steps frames on, with a single redraw."""
+		self.curindex = (self.curindex + steps) % len(self.tiles)
+		self._show(self.curindex)
+
+
+class Anibox(tk.Frame, Animation):
+	def __init__(self, master, cnf={}, **kw):
+		# Setup Anibox spefic attributes
+		sizemult = self._setAnimation(kw)
+		# Load the tileset in the background, see loadTileset()
+		background = kw.pop('background', False)
+		self.loading = None
+		if background:
+			tileset = self.tileset
+			self.tiles = self._getTiles(self.placeholder, sizemult)
+		else:
+			self.tiles = self._getTiles(self.tileset, sizemult)
+		self.scheduler = kw.pop('scheduler', None)
+		self.updatetime = time.time()
+		
+		# container background
+		tsbg = kw.pop('tbg', 'lightgrey') 
+		
+		# Call to Frame.__init__() must happen before creating container
+		tk.Frame.__init__(self, master, cnf, **kw)
+		# Held so frames dropped by a LazyAtlas stay alive while shown
+		self.image = self.tiles[0]
+		self.container = tk.Label(self, image=self.image, border=0, bg=tsbg)
+		self.container.pack()
+		self.pos = self.getPos()
+	
+		# FPS tracking
+		self.updatetime_prev = None
+		
+		if background:
+			self.loadTileset(tileset, sizemult=sizemult)
+		
+	def changespeed(self, speed):
+		if Animation.changespeed(self, speed) is False:
+			return False
 		print(self.speed)
 		self.stop()
 		self.start()
@@ -92,12 +347,43 @@ class Anibox(tk.Frame):
 		self.container.config(bg=color)
 	
 	def newTileset(self, path, **kw):
+		self.loading = None
+		Animation.newTileset(self, path, **kw)
 	
+	def loadTileset(self, path, callback=None, **kw):
+		"""newTileset() with the tileset decoded in a worker thread, showing
+		the placeholder until it is ready. Returns a concurrent Future set
+		to self once the new frames are shown (under tkasync, await it with
+		asyncio.wrap_future), and calls callback(self) then. The Future is
+		cancelled if another tileset is set first."""
 		speed = kw.pop('speed', self.speed)
 		sizemult = kw.pop('sizemult', 1)
-		self.tiles = self._getTiles(path, sizemult)
-		self.container.config(image=self.tiles[0])
-		self.speed = speed
+		self.newTileset(self.placeholder, sizemult=sizemult)
+		done = Future()
+		self.loading = done
+		
+		def finish(work):
+			if self.loading is not done:
+				done.cancel()
+				return
+			self.loading = None
+			try:
+				self.tileset, atlas = work.result()
+				self.tiles = lazyFrames(atlas, self.lazy)
+				self.curindex = 0
+				self._show(0)
+			except Exception as e:
+				done.set_exception(e)
+				return
+			self.speed = speed
+			done.set_result(self)
+			if callback is not None:
+				callback(self)
+		
+		work = atlases.load(self, path, self.tile_dimensions, sizemult,
+			self.placeholder, self.lazy)
+		work.add_done_callback(finish)
+		return done
 	
 	def update(self):
 		self.updatetime_prev = self.updatetime
@@ -114,7 +400,16 @@ class Anibox(tk.Frame):
 			newpos = i + 1
 
 		self.curindex = newpos
-		self.container.config(image=self.tiles[newpos])
+		self._show(newpos)
+		
+	def _show(self, i):
+		self.image = self.tiles[i]
+		self.container.config(image=self.image)
+		
+	def advance(self, steps=1):
+		self.updatetime_prev = self.updatetime
+		self.updatetime = time.time()
+		Animation.advance(self, steps)
 		
 	def getFps(self):
 		return 1 / self.speed
@@ -128,15 +423,222 @@ class Anibox(tk.Frame):
 			return 0
 
 	def start(self):
+		if self.scheduler is not None:
+			self.scheduler.add(self)
+			return
 		self.update()
 		self.stop_id = self.after(self.speed, self.start)
 
+	async def animate(self):
+		"""start() as a coroutine, for when Tk is driven from asyncio
+		(see tkasync). Runs until its task is cancelled."""
+		while True:
+			self.update()
+			await asyncio.sleep(self.speed / 1000)
+
 	def stop(self):
+		if self.scheduler is not None:
+			self.scheduler.remove(self)
+			return
 		try:
 			self.after_cancel(self.stop_id)
 		except:
 			print("Animation has not started!")
+			
+	def destroy(self):
+		if self.scheduler is not None:
+			self.scheduler.remove(self)
+		tk.Frame.destroy(self)
+
+
+class AnimationScheduler(object):
+	"""One timer for any number of Aniboxes, given as their scheduler.
+	Every frame ms each started one is moved on by however many of its
+	speed periods have passed on the scene clock since it was started, so
+	a late tick drops the frames it missed rather than letting animations
+	drift apart. pause() stops the clock for the whole scene."""
+	def __init__(self, master, frame=16):
+		self.master = master
+		self.frame = frame
+		# Anibox: [clock when started, frames shown, speed]
+		self.anims = {}
+		self.paused_at = None
+		self.offset = 0.0
+		self.stop_id = None
+	
+	def clock(self):
+		"""Seconds on the scene clock, which stands still while paused."""
+		if self.paused_at is not None:
+			return self.paused_at - self.offset
+		return time.monotonic() - self.offset
+	
+	def add(self, anibox):
+		self.anims[anibox] = [self.clock(), 0, anibox.speed]
+		self._schedule()
+	
+	def remove(self, anibox):
+		self.anims.pop(anibox, None)
+		if len(self.anims) == 0:
+			self._cancel()
+	
+	def pause(self):
+		if self.paused_at is None:
+			self.paused_at = time.monotonic()
+			self._cancel()
+	
+	def resume(self):
+		if self.paused_at is not None:
+			self.offset += time.monotonic() - self.paused_at
+			self.paused_at = None
+			self._schedule()
+	
+	def isPaused(self):
+		return self.paused_at is not None
+	
+	def tick(self):
+		self.stop_id = None
+		now = self.clock()
+		for anibox, state in list(self.anims.items()):
+			if anibox.speed != state[2]:
+				# Speed changed, count periods from here
+				state[:] = [now, 0, anibox.speed]
+				continue
+			due = int((now - state[0]) * 1000 // state[2])
+			if due == state[1]:
+				continue
+			try:
+				anibox.advance(due - state[1])
+			except tk.TclError:
+				# Destroyed some other way
+				del self.anims[anibox]
+				continue
+			state[1] = due
+		self._schedule()
+	
+	def _schedule(self):
+		if self.stop_id is None and self.paused_at is None and self.anims:
+			self.stop_id = self.master.after(self.frame, self.tick)
+	
+	def _cancel(self):
+		if self.stop_id is not None:
+			self.master.after_cancel(self.stop_id)
+			self.stop_id = None
 		
+class Sprite(Animation):
+	"""An animation drawn as an image item of a SpriteLayer, with the
+	tileset, speed and sizemult options of an Anibox. Made by
+	SpriteLayer.add()."""
+	def __init__(self, layer, x, y, z=0, **kw):
+		self.layer = layer
+		sizemult = self._setAnimation(kw)
+		self.tiles = self._getTiles(self.tileset, sizemult)
+		self.z = z
+		self.image = self.tiles[0]
+		self.item = layer.create_image(x, y, image=self.image, **kw)
+	
+	def _show(self, i):
+		self.image = self.tiles[i]
+		self.layer.itemconfigure(self.item, image=self.image)
+	
+	def start(self):
+		self.layer.scheduler.add(self)
+	
+	def stop(self):
+		self.layer.scheduler.remove(self)
+	
+	def getPos(self):
+		return self.layer.coords(self.item)
+	
+	def moveTo(self, x, y):
+		self.layer.coords(self.item, x, y)
+	
+	def move(self, dx, dy):
+		self.layer.move(self.item, dx, dy)
+	
+	def setZ(self, z):
+		old = self.z
+		self.z = z
+		self.layer.restack(self, old)
+	
+	def remove(self):
+		self.layer.remove(self)
+
+
+def zTag(z):
+	# The canvas tag of the sprites at z, the same for 1 and 1.0
+	return 'z%r' % float(z)
+
+
+class SpriteLayer(tk.Canvas):
+	"""Many animations on one Canvas, for scenes where an Anibox widget
+	per sprite is too slow: each tick only the image items whose frame
+	changed are reconfigured. Sprites are stacked by z, higher on top,
+	and all move on from one AnimationScheduler."""
+	def __init__(self, master, cnf={}, **kw):
+		scheduler = kw.pop('scheduler', None)
+		frame = kw.pop('frame', 16)
+		tk.Canvas.__init__(self, master, cnf, **kw)
+		if scheduler is None:
+			scheduler = AnimationScheduler(self, frame)
+		self.scheduler = scheduler
+		self.sprites = {}
+		# Sprites per z in use, and those z in order
+		self.levels = {}
+		self.zs = []
+	
+	def add(self, x, y, z=0, **kw):
+		"""A new Sprite at x, y; kw takes the Anibox options (tileset,
+		speed, sizemult) and those of Canvas.create_image."""
+		kw.setdefault('anchor', 'nw')
+		sprite = Sprite(self, x, y, z, **kw)
+		self.sprites[sprite.item] = sprite
+		self.restack(sprite)
+		return sprite
+	
+	def remove(self, sprite):
+		sprite.stop()
+		self.delete(sprite.item)
+		del self.sprites[sprite.item]
+		self._leave(sprite.z)
+	
+	def restack(self, sprite, old=None):
+		"""Put sprite on top of those of its z, below any higher one;
+		old is the z it had, if it was stacked before. Each z has its
+		own tag, so this doesn't go through the other items."""
+		if old is not None:
+			self.dtag(sprite.item, zTag(old))
+			self._leave(old)
+		z = sprite.z
+		if z in self.levels:
+			self.tag_raise(sprite.item, zTag(z))
+		else:
+			i = bisect.bisect_right(self.zs, z)
+			if i < len(self.zs):
+				self.tag_lower(sprite.item, zTag(self.zs[i]))
+			else:
+				self.tag_raise(sprite.item)
+			self.zs.insert(i, z)
+			self.levels[z] = 0
+		self.levels[z] += 1
+		self.addtag_withtag(zTag(z), sprite.item)
+	
+	def _leave(self, z):
+		self.levels[z] -= 1
+		if not self.levels[z]:
+			del self.levels[z]
+			self.zs.remove(z)
+	
+	def pause(self):
+		self.scheduler.pause()
+	
+	def resume(self):
+		self.scheduler.resume()
+	
+	def destroy(self):
+		for sprite in list(self.sprites.values()):
+			self.scheduler.remove(sprite)
+		tk.Canvas.destroy(self)
+
 def main():		
 	root = tk.Tk()
 	ani = Anibox(root, tileset='example.png', speed=0.5, sizemult=10)
@@ -0,0 +1,278 @@
+"""Benchmarks for DatParser.
+
+Generates synthetic .DAT corpora of a few shapes, measures parsing, lookups
+and saving on them, and stores the results as JSON so runs from different
+versions can be compared:
+
+    python datbench.py --gobs 5000 --out new.json
+    python datbench.py --gobs 5000 --out new.json --compare old.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import tempfile
+import time
+import tracemalloc
+
+from datparser import DatParser, DatSchema
+from general import isFloat, isInt, toScalar
+
+# Shapes of generated corpora. Every GOB gets a type, subtype, name and a
+# few numbers; these add the parts that stress the parser.
+SHAPES = {
+    # Lots of tiny headers
+    'small': dict(desc_lines=0, list_len=2, escaped=0, compounds=0),
+    # Long multi-line quoted descriptions
+    'longdesc': dict(desc_lines=30, list_len=2, escaped=0, compounds=0),
+    # Large [...] lists, some spread over several lines
+    'biglists': dict(desc_lines=0, list_len=200, escaped=0, compounds=0),
+    # Lists full of escaped commas
+    'escaped': dict(desc_lines=0, list_len=20, escaped=10, compounds=0),
+    # Repeated attribute names, merged into compound values
+    'compound': dict(desc_lines=1, list_len=2, escaped=0, compounds=5),
+}
+
+# What generate() writes, for typed parsing
+SCHEMA = DatSchema({'*': {
+    'name': 'str', 'type': 'str', 'subtype': 'str', 'desc': 'str',
+    'health': 'int', 'weight': 'float', 'attack': 'int', 'bodyparts': 'refs',
+    }})
+
+WORDS = ('the', 'rusty', 'sword', 'of', 'a', 'forgotten', 'king', 'lies',
+    'in', 'dark', 'room', 'beneath', 'castle', 'void', 'sam', 'burnt')
+
+
+def _words(rng, n):
+    return ' '.join(rng.choice(WORDS) for _ in range(n))
+
+
+def generate(path, gobs=1000, desc_lines=1, list_len=10, escaped=0,
+        compounds=0, seed=0):
+    """Write a synthetic .DAT file of gobs sections to path."""
+
+    rng = random.Random(seed)
+    types = [('actor', 'enemy'), ('actor', 'friendly'),
+        ('item', 'equipment'), ('item', 'consumable'), ('room', 'room')]
+    with open(path, 'w') as dat:
+        for i in range(gobs):
+            type, subtype = types[i % len(types)]
+            dat.write('[gob %d]\n' % i)
+            dat.write('name = gob %d\n' % i)
+            dat.write('type = %s\nsubtype = %s\n' % (type, subtype))
+            dat.write('health = %d\n' % rng.randint(1, 500))
+            dat.write('weight = %.2f\n' % (rng.random() * 100))
+            dat.write('attack = %d\n' % rng.randint(0, 50))
+
+            if desc_lines > 1:
+                lines = [_words(rng, 10) for _ in range(desc_lines)]
+                dat.write('desc = "%s"\n' % '\n'.join(lines))
+            elif desc_lines == 1:
+                dat.write('desc = %s\n' % _words(rng, 8))
+
+            items = ['part %d' % rng.randint(0, 99) for _ in range(list_len)]
+            for j in range(min(escaped, len(items))):
+                items[j] = items[j] + '\\, ' + _words(rng, 2)
+            if list_len > 50:
+                # Long lists wrap onto following lines
+                rows = [','.join(items[k:k+25])
+                    for k in range(0, len(items), 25)]
+                dat.write('bodyparts = [%s,]\n' % ',\n'.join(rows))
+            else:
+                dat.write('bodyparts = [%s,]\n' % ','.join(items))
+
+            for j in range(compounds):
+                dat.write('effect = %s\n' % _words(rng, 2))
+            dat.write('\n\n')
+
+
+def _best(func, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        passed = time.perf_counter() - start
+        if best is None or passed < best:
+            best = passed
+    return best
+
+
+def _read(path, **kw):
+    parser = DatParser(**kw)
+    parser.read(path)
+    return parser
+
+
+def benchShape(workdir, shape, gobs, repeat=3, lookups=200):
+    """Run every measurement on one generated corpus."""
+
+    path = os.path.join(workdir, '%s.DAT' % shape)
+    generate(path, gobs, **SHAPES[shape])
+    # Age the file so the cache trusts its mtime without hashing it
+    old = time.time_ns() - 60 * 10**9
+    os.utime(path, ns=(old, old))
+    results = {'bytes': os.path.getsize(path), 'gobs': gobs}
+
+    try:
+        results['parse_legacy_s'] = _best(
+            lambda: _read(path, engine='legacy', cache=False), repeat)
+    except AttributeError:
+        # The legacy engine fails on a name that was a compound in an
+        # earlier header, as in the 'compound' shape
+        pass
+    results['parse_s'] = _best(lambda: _read(path, cache=False), repeat)
+    results['parse_typed_s'] = _best(
+        lambda: _read(path, cache=False, schema=SCHEMA), repeat)
+    _read(path)
+    results['parse_cached_s'] = _best(lambda: _read(path), repeat)
+    results['parse_typed_cached_s'] = _best(
+        lambda: _read(path, schema=SCHEMA), repeat)
+    results['iterparse_s'] = _best(
+        lambda: sum(1 for _ in DatParser().iterparse(path)), repeat)
+
+    tracemalloc.start()
+    parser = _read(path, cache=False)
+    results['parse_peak_bytes'] = tracemalloc.get_traced_memory()[1]
+    results['raws_bytes'] = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    
+    tracemalloc.start()
+    columnar = _read(path, cache=False, columnar=True)
+    results['columnar_peak_bytes'] = tracemalloc.get_traced_memory()[1]
+    results['columnar_bytes'] = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del(columnar)
+
+    results['getGobs_s'] = _best(parser.getGobs, repeat)
+    rng = random.Random(1)
+    keys = [rng.choice(list(parser.getRaws())) for _ in range(lookups)]
+    results['getGob_us'] = _best(
+        lambda: [parser.getGob(key).getAttributes() for key in keys],
+        repeat) / lookups * 1e6
+    results['find_us'] = _best(
+        lambda: [parser.find(type='actor', subtype='enemy')
+            for _ in range(lookups)], repeat) / lookups * 1e6
+
+    results['query_loop_s'] = _best(
+        lambda: [gob for gob in parser.getGobs()
+            if gob.getAttr('type') == 'actor' and gob.getAttr('health') > 250],
+        repeat)
+    results['query_s'] = _best(
+        lambda: parser.query(type='actor').where('health', '>', 250),
+        repeat)
+    
+    def edit():
+        parser.updateValue(keys[0], 'health', str(rng.randint(1, 500)))
+        parser.save()
+    results['save_edit_s'] = _best(edit, repeat)
+    results['save_full_s'] = _best(lambda: parser.save(full=True), repeat)
+    return results
+
+
+def _cascade(s):
+    # What general.toNum did before toScalar: isNum(), then isFloat() and
+    # isInt() all over again
+    if not (isFloat(s) or isInt(s)):
+        return s
+    if isFloat(s):
+        return float(s)
+    elif isInt(s):
+        return int(s)
+
+
+def benchCoerce(values=100000, repeat=3):
+    """Per-value cost of toScalar against the old toNum cascade, over a
+    mix of values like those found in .DAT attributes."""
+
+    rng = random.Random(2)
+    words = ('actor', 'item', 'equipment', 'consumable', 'enemy', 'room')
+    mix = []
+    for _ in range(values):
+        kind = rng.random()
+        if kind < 0.35:
+            mix.append(str(rng.randint(0, 500)))
+        elif kind < 0.5:
+            mix.append('%.2f' % (rng.random() * 100))
+        elif kind < 0.8:
+            mix.append(rng.choice(words))
+        else:
+            mix.append(_words(rng, 6))
+
+    results = {'values': values}
+    results['cascade_ns'] = _best(
+        lambda: [_cascade(v) for v in mix], repeat) / values * 1e9
+    results['toScalar_ns'] = _best(
+        lambda: [toScalar(v) for v in mix], repeat) / values * 1e9
+    return results
+
+
+def run(gobs=1000, shapes=None, repeat=3):
+    shapes = shapes or list(SHAPES)
+    workdir = tempfile.mkdtemp(prefix='datbench')
+    try:
+        results = {}
+        for shape in shapes:
+            results[shape] = benchShape(workdir, shape, gobs, repeat)
+    finally:
+        shutil.rmtree(workdir)
+    results['coerce'] = benchCoerce(repeat=repeat)
+
+    return {
+        'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'gobs': gobs,
+        'results': results,
+    }
+
+
+def report(run, baseline=None, threshold=0.10):
+    """Print run as a table. With a baseline run, add the ratio of every
+    metric and flag those more than threshold worse."""
+
+    sizes = ('gobs', 'bytes', 'values')
+    lines = []
+    for shape, metrics in run['results'].items():
+        lines.append('[%s] %s' % (shape, ', '.join('%d %s' % (
+            metrics[name], name) for name in sizes if name in metrics)))
+        old = {}
+        if baseline is not None:
+            old = baseline['results'].get(shape, {})
+        for name, value in metrics.items():
+            if name in sizes:
+                continue
+            line = '  %-18s %14.6g' % (name, value)
+            if old.get(name):
+                ratio = value / old[name]
+                line += '  x%.2f' % ratio
+                if ratio > 1 + threshold:
+                    line += '  REGRESSION'
+            lines.append(line)
+    return '\n'.join(lines)
+
+
+def main():
+    argparser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    argparser.add_argument('--gobs', type=int, default=1000)
+    argparser.add_argument('--shapes', nargs='*', choices=list(SHAPES))
+    argparser.add_argument('--repeat', type=int, default=3)
+    argparser.add_argument('--out', help='write results to this JSON file')
+    argparser.add_argument('--compare', help='JSON results to compare with')
+    args = argparser.parse_args()
+
+    results = run(args.gobs, args.shapes, args.repeat)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print(report(results, baseline))
+
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -1,11 +1,567 @@
 from general import *
+from array import array
+from collections.abc import MutableMapping
+from concurrent.futures import ProcessPoolExecutor
+from itertools import compress, repeat
+import bisect
+import hashlib
+import locale
+import marshal
+import mmap
+import operator
 import os
+import re
+import shutil
+import sys
+import time
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Stands in for attributes a GOB doesn't have
+_MISSING = object()
+
+class DatLines(object):
+    """Iterates the lines of a .DAT file's bytes the way a text mode file
+    would, remembering the byte offset the last line started at. data is
+    either all of the bytes or a binary file to stream lines from."""
+    
+    def __init__(self, data, encoding=None):
+        if isinstance(data, bytes):
+            self.lines = iter(data.splitlines(True))
+        elif hasattr(data, 'readline'):
+            # Binary files and mmaps
+            self.lines = iter(data.readline, b'')
+        else:
+            self.lines = iter(data)
+        self.encoding = encoding or locale.getpreferredencoding(False)
+        self.pos = 0
+        self.start = 0
+        
+    def __iter__(self):
+        return self
+        
+    def __next__(self):
+        line = next(self.lines)
+        self.start = self.pos
+        self.pos += len(line)
+        line = line.decode(self.encoding)
+        if line[-1:] == '\r':
+            line = line.rstrip('\r\n') + '\n'
+        elif line[-2:] == '\r\n':
+            line = line[:-2] + '\n'
+        return line
+
+
+class DatTokenizer(object):
+    """A single pass lexer for the .DAT format. Every line is classified
+    once as a header or an attribute, and every value once as quoted,
+    list or scalar, yielding (kind, key, value) tokens. The value of a
+    header token is the byte offset of its line when reading DatLines.
+    With raw, scalars are left as the strings they were written as in RAW
+    tokens, to be coerced or decoded by a DatSchema when they're read."""
+    
+    HEADER = 0
+    ATTR = 1
+    RAW = 2
+    
+    # Unescaped list separators and the closing delimiter
+    _list_delims = re.compile(r'(?<!\\),|\]')
+    
+    def tokens(self, lines, raw=False):
+        HEADER, ATTR, RAW = self.HEADER, self.ATTR, self.RAW
+        lines = iter(lines)
+        for line in lines:
+            line = line.strip()
+            if not line:
+                continue
+            
+            if line[0] == '[' and line[-1] == ']':
+                yield (HEADER, line.lstrip('[').rstrip(']'),
+                    getattr(lines, 'start', None))
+                continue
+            
+            if line.count('=') != 1:
+                continue
+            name, value = line.split('=')
+            value = value.strip()
+            
+            lead = value[:1]
+            if lead == '"':
+                value = self._quoted(value, lines)
+            elif lead == '[':
+                value = self._list(value, lines)
+            elif raw:
+                yield RAW, name.strip(), value
+                continue
+            else:
+                value = toScalar(value)
+            yield ATTR, name.strip(), value
+    
+    def _quoted(self, value, lines):
+        value = value.lstrip('"')
+        end = value.find('"')
+        if end != -1:
+            return value[0:end]
+        
+        parts = [value]
+        for line in lines:
+            parts.append('\n')
+            end = line.find('"')
+            if end != -1:
+                parts.append(line[0:end])
+                return ''.join(parts)
+            parts.append(line)
+    
+    def _list(self, value, lines):
+        if value.find(']') == -1:
+            parts = [value, '\n']
+            for line in lines:
+                parts.append(line)
+                if line.find(']') != -1:
+                    break
+            value = ''.join(parts)
+        
+        vals = []
+        start = 1
+        for match in self._list_delims.finditer(value):
+            end = match.start()
+            vals.append(value[start:end].strip())
+            if match.group() == ',':
+                start = end + 1
+        return vals
+    
+
+
+class DatCache(object):
+    """Compiled .DATC sidecars holding the token stream of a .DAT file, so
+    reading an unchanged file is a single marshal load. A sidecar is
+    trusted when the size and mtime of its .DAT match; a .DAT modified
+    shortly before its sidecar was written is also checked by hash, as
+    its mtime alone can't tell two quick edits apart. Other sidecars,
+    like MappedDat's .DATI index, use the same checks with their own ext."""
+    
+    EXT = 'C'
+    VERSION = 4
+    RACY_NS = 2 * 10**9
+    
+    def __init__(self, ext=None):
+        if ext is not None:
+            self.EXT = ext
+    
+    def path(self, fpath):
+        return fpath + self.EXT
+    
+    def load(self, fpath, stat):
+        try:
+            with open(self.path(fpath), 'rb') as cfile:
+                stamp = marshal.loads(cfile.read())
+        except (OSError, EOFError, ValueError, TypeError):
+            return None
+        
+        try:
+            version, mtime, size, digest, written, tokens = stamp
+        except (TypeError, ValueError):
+            return None
+        if version != (self.VERSION, marshal.version):
+            return None
+        if mtime != stat.st_mtime_ns or size != stat.st_size:
+            return None
+        if mtime + self.RACY_NS >= written:
+            with open(fpath, 'rb') as file:
+                if hashlib.sha1(file.read()).hexdigest() != digest:
+                    return None
+        return tokens
+    
+    def store(self, fpath, stat, data, tokens):
+        stamp = (
+            (self.VERSION, marshal.version),
+            stat.st_mtime_ns,
+            stat.st_size,
+            hashlib.sha1(data).hexdigest(),
+            time.time_ns(),
+            tokens)
+        cpath = self.path(fpath)
+        tmp = cpath + '.tmp'
+        try:
+            with open(tmp, 'wb') as cfile:
+                cfile.write(marshal.dumps(stamp))
+            os.replace(tmp, cpath)
+        except OSError:
+            # A read-only data directory just means no cache
+            return False
+        return True
+    
+    def clear(self, fpath):
+        try:
+            os.remove(self.path(fpath))
+        except OSError:
+            pass
+
+
+class SchemaError(Exception):
+    def __init__(self, header, name, kind, value):
+        message = "[%s] %s should be %s, not %r" % (header, name, kind, value)
+        super(SchemaError, self).__init__(message)
+
+
+# Decoders for each kind of DatSchema attribute, for the values the
+# tokenizer has already taken apart: quoted strings and lists. Raw scalar
+# strings go straight to int() and float(), and are kept as written for
+# 'str'. Either raises ValueError or TypeError for a value that isn't of
+# its kind.
+
+def _decodeInt(value):
+    if not isinstance(value, str):
+        raise TypeError(value)
+    return int(value)
+
+def _decodeFloat(value):
+    if not isinstance(value, str):
+        raise TypeError(value)
+    return float(value)
+
+def _decodeNum(value):
+    if isinstance(value, str):
+        value = toScalar(value)
+    if type(value) not in (int, float):
+        raise ValueError(value)
+    return value
+
+def _decodeStr(value):
+    if isinstance(value, str):
+        return value
+    raise TypeError(value)
+
+def _decodeList(value):
+    if isinstance(value, list):
+        return value
+    raise TypeError(value)
+
+
+class DatSchema(object):
+    """Declares the attributes of each GOB type as {type: {name: kind}}.
+    'type/subtype' keys add to or override their type's attributes, and
+    '*' holds those every GOB has. Kinds are 'int', 'float', 'num' (int or
+    float), 'str', 'list' and 'refs', a list of other GOBs' names.
+    
+    A DatParser given a schema decodes each declared attribute straight to
+    its kind instead of guessing, raising SchemaError for values that
+    don't fit; undeclared attributes are read as usual. This is for
+    checked, predictable values rather than speed: most of reading goes
+    to tokenizing, so a schema costs about what it saves."""
+    
+    # kind: (decoder for raw scalars, decoder for other values), where
+    # None leaves the value as it is
+    KINDS = {
+        'int': (int, _decodeInt),
+        'float': (float, _decodeFloat),
+        'num': (_decodeNum, _decodeNum),
+        'str': (None, _decodeStr),
+        'list': (_decodeList, _decodeList),
+        'refs': (_decodeList, _decodeList),
+        }
+    
+    def __init__(self, types):
+        for fields in types.values():
+            for name, kind in fields.items():
+                if kind not in self.KINDS:
+                    raise ValueError('%s has unknown kind %r' % (name, kind))
+        self.types = types
+        self.decoders = {}
+        self.compiled = {}
+    
+    def fields(self, type, subtype=None):
+        """{name: kind} of every attribute declared for type and subtype."""
+        fields = dict(self.types.get('*', {}))
+        if isinstance(type, str):
+            fields.update(self.types.get(type, {}))
+            if isinstance(subtype, str):
+                fields.update(self.types.get('%s/%s' % (type, subtype), {}))
+        return fields
+    
+    def decoder(self, type, subtype=None):
+        """({name: decode}, {name: decode}) for type and subtype, for raw
+        scalar values and for the rest, compiled once and kept. Values
+        that don't decode are fine as long as they're empty, as the editor
+        writes unset fields that way."""
+        try:
+            return self.decoders[type, subtype]
+        except KeyError:
+            pass
+        except TypeError:
+            # An unhashable type or subtype can't match anything anyway
+            type = subtype = None
+        fields = self.fields(type, subtype)
+        # Types declaring the same attributes share a decoder
+        same = frozenset(fields.items())
+        decoder = self.compiled.get(same)
+        if decoder is None:
+            decoder = self.compiled[same] = (
+                dict((name, self.KINDS[kind][0])
+                    for name, kind in fields.items()),
+                dict((name, self.KINDS[kind][1])
+                    for name, kind in fields.items()))
+        self.decoders[type, subtype] = decoder
+        return decoder
+    
+    def refs(self, type, subtype=None):
+        """Names of the attributes of type and subtype holding references."""
+        return [name for name, kind in self.fields(type, subtype).items()
+            if kind == 'refs']
+
+
+# The attributes the editor knows about for each type of GOB
+default_schema = DatSchema({
+    '*': {'name': 'str', 'desc': 'str', 'type': 'str', 'subtype': 'str'},
+    'item': {'weight': 'num'},
+    'item/equipment': {'attack': 'int', 'defense': 'int',
+        'bodyparts': 'refs', 'positions': 'list'},
+    'item/consumable': {'uses': 'int'},
+    'actor': {'health': 'int', 'equipped': 'refs', 'bag': 'refs',
+        'bodyparts': 'refs'},
+    'room': {'distant': 'str', 'items': 'refs', 'actors': 'refs'},
+    'conversation': {'actor': 'refs', 'convobits': 'list'},
+    'effect': dict((name, 'num') for name in ('duration', 'rate', 'health',
+        'defense', 'intelligence', 'dexterity', 'strength', 'speak',
+        'agility')),
+    })
+
+
+def _storeAttr(attrs, name, value, compounds):
+    # Is there more than one attribute with this name?
+    if name in attrs:
+        # If so, convert it into a list
+        # and append to it from now on. A name that became a compound
+        # in an earlier header still has to be converted in this one,
+        # where the legacy engine calls append() on its first value.
+        if name not in compounds or not isinstance(attrs[name], list):
+            if name not in compounds:
+                compounds.append(name)
+            original_value = attrs[name]
+            attrs[name] = []
+            attrs[name].append(original_value)
+        attrs[name].append(value)
+    else:
+        attrs[name] = value
+
+
+class DatRow(MutableMapping):
+    """The attributes of one header of a DatColumns, behaving like the
+    dict DatParser.raws would otherwise hold for it."""
+    
+    __slots__ = ('_columns', '_row')
+    
+    def __init__(self, columns, row):
+        self._columns = columns
+        self._row = row
+        
+    def __getitem__(self, key):
+        if key not in self._columns.shapes[self._row]:
+            raise KeyError(key)
+        return self._columns.columns[key][self._row]
+        
+    def get(self, key, default=None):
+        if key not in self._columns.shapes[self._row]:
+            return default
+        return self._columns.columns[key][self._row]
+        
+    def __contains__(self, key):
+        return key in self._columns.shapes[self._row]
+        
+    def __setitem__(self, key, value):
+        self._columns._set(self._row, key, value)
+        
+    def __delitem__(self, key):
+        if key not in self._columns.shapes[self._row]:
+            raise KeyError(key)
+        self._columns._delete(self._row, key)
+        
+    def __iter__(self):
+        return iter(self._columns.shapes[self._row])
+        
+    def __len__(self):
+        return len(self._columns.shapes[self._row])
+        
+    def __repr__(self):
+        return repr(dict(self))
+        
+    def __reduce__(self):
+        # Copies and pickles are plain dicts rather than the whole store
+        return (dict, (dict(self),))
+    
+
+class DatColumns(MutableMapping):
+    """A compact stand-in for DatParser.raws. Each attribute name has one
+    column holding its value for every header: an array of machine ints
+    or floats while all of its values are one or the other, otherwise a
+    list of interned strings and other values. Each header only keeps the
+    tuple of names it has, in order, shared with every header having the
+    same ones. Indexing gives a DatRow, a dict-like view of one header."""
+    
+    # Array typecodes of numeric columns
+    TYPECODES = {int: 'q', float: 'd'}
+    
+    def __init__(self, raws=None):
+        self.rows = {}
+        self.shapes = []
+        self.columns = {}
+        self.free = []
+        self._shapes = {}
+        if raws:
+            self.update(raws)
+            
+    def _shape(self, names):
+        return self._shapes.setdefault(names, names)
+        
+    def _compact(self, value):
+        if type(value) is str:
+            return sys.intern(value)
+        if type(value) is list:
+            # In place, so anyone holding the list still sees it stored
+            for i, item in enumerate(value):
+                if type(item) is str:
+                    value[i] = sys.intern(item)
+        return value
+        
+    def _set(self, row, key, value):
+        column = self.columns.get(key)
+        if column is None:
+            if type(key) is str:
+                key = sys.intern(key)
+            typecode = self.TYPECODES.get(type(value))
+            column = array(typecode) if typecode else []
+            self.columns[key] = column
+        if len(column) <= row:
+            filler = 0 if type(column) is array else None
+            column.extend([filler] * (len(self.shapes) - len(column)))
+        
+        if type(column) is list:
+            column[row] = self._compact(value)
+        elif self.TYPECODES.get(type(value)) == column.typecode:
+            try:
+                column[row] = value
+            except OverflowError:
+                column = self._demote(key)
+                column[row] = value
+        else:
+            column = self._demote(key)
+            column[row] = self._compact(value)
+        
+        shape = self.shapes[row]
+        if key not in shape:
+            self.shapes[row] = self._shape(shape + (key,))
+            
+    def _demote(self, key):
+        # A value that doesn't fit its numeric column turns it into a list
+        column = self.columns[key] = list(self.columns[key])
+        return column
+        
+    def _delete(self, row, key):
+        column = self.columns[key]
+        if type(column) is list:
+            column[row] = None
+        self.shapes[row] = self._shape(
+            tuple(name for name in self.shapes[row] if name != key))
+            
+    def _clear(self, row):
+        for key in self.shapes[row]:
+            column = self.columns[key]
+            if type(column) is list:
+                column[row] = None
+        self.shapes[row] = ()
+        
+    def __getitem__(self, header):
+        return DatRow(self, self.rows[header])
+        
+    def __contains__(self, header):
+        return header in self.rows
+        
+    def __setitem__(self, header, attrs):
+        if isinstance(attrs, DatRow):
+            attrs = dict(attrs)
+        row = self.rows.get(header)
+        if row is None:
+            if self.free:
+                row = self.free.pop()
+            else:
+                row = len(self.shapes)
+                self.shapes.append(())
+            if type(header) is str:
+                header = sys.intern(header)
+            self.rows[header] = row
+        else:
+            self._clear(row)
+        for key, value in attrs.items():
+            self._set(row, key, value)
+            
+    def __delitem__(self, header):
+        row = self.rows.pop(header)
+        self._clear(row)
+        self.free.append(row)
+        
+    def pop(self, header, *default):
+        if header not in self.rows:
+            if default:
+                return default[0]
+            raise KeyError(header)
+        attrs = dict(self[header])
+        del(self[header])
+        return attrs
+        
+    def __iter__(self):
+        return iter(self.rows)
+        
+    def __len__(self):
+        return len(self.rows)
+        
+    def column(self, name):
+        """{header: value} of every header having name."""
+        column = self.columns.get(name)
+        if column is None:
+            return {}
+        shapes = self.shapes
+        return dict((header, column[row]) for header, row in self.rows.items()
+            if name in shapes[row])
+
 
 class DatParser(object):
-    def __init__(self):
-        self.raws = {}
+    def __init__(self, engine='token', cache=True, schema=None,
+            columnar=False):
+        """engine selects how files are read: 'token' uses the single
+        pass DatTokenizer, 'legacy' the original line predicates. With
+        cache, tokenized files are kept in .DATC sidecars (see DatCache).
+        A DatSchema given as schema decodes and checks the attributes it
+        declares when reading with the token engine; its files have .DATR
+        sidecars, holding scalars as written for it to decode. columnar keeps raws
+        as a DatColumns, using far less memory for large files: sections
+        are packed into it as they're read. A file's cached tokens are
+        still loaded whole, so cache=False keeps memory lowest."""
+        self.raws = DatColumns() if columnar else {}
         self.compounds = []
         self.dat_paths = []
+        self.engine = engine
+        self.schema = schema
+        self.tokenizer = DatTokenizer()
+        self.cache = DatCache() if cache else None
+        self.raw_cache = DatCache('R') if cache else None
+        self.encoding = locale.getpreferredencoding(False)
+        
+        # Where each header came from, for save(). spans holds the
+        # (start, end) byte range of a header's section in its file, good
+        # while the file's stamp is the one it had when read.
+        self.sources = {}
+        self.spans = {}
+        self.stamps = {}
+        self.dirty = {}
+        self.removed = {}
+        
+        # attribute -> {value: {header: None}}, see find()
+        self.indexes = {'name': {}, 'type': {}, 'subtype': {}}
+        self.order = {}
+        self.next_order = 0
 
     def _isAttr(self, line):
         if len(line.split('=')) == 2:
@@ -103,53 +659,350 @@ class DatParser(object):
         elif self._isListValue(s):
             value = self._handleListValue(s)
         else:
-            value = toNum(s)
+            value = toScalar(s)
         
         return value
     
-    def read(self, *fpaths):
+    def read(self, *fpaths, workers=None):
+        """Read fpaths into raws, returning the paths that failed to open.
+        With workers, the files are tokenized in that many processes at
+        once (from a script, under an if __name__ == '__main__' guard) and
+        merged in the order given, exactly as a sequential read would."""
+        
         failed = []
         header = 'global'
-        for fpath in fpaths:
+        loaded = None
+        raw = self.schema is not None
+        if workers and self.engine != 'legacy' and len(fpaths) > 1:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                loaded = list(pool.map(_loadTokens, fpaths,
+                    repeat(self.encoding), repeat(self.cache is not None),
+                    repeat(raw)))
+        
+        for i, fpath in enumerate(fpaths):
             try:
-                with open(fpath) as file:
-                    pass
+                if self.engine == 'legacy':
+                    with open(fpath) as file:
+                        self.stamps[fpath] = _stamp(os.fstat(file.fileno()))
+                        header = self._readLegacy(file, header, fpath)
+                    continue
+                elif loaded is None:
+                    tokens, size, stamp = self._tokensFor(fpath, raw)
+                elif loaded[i] is None:
+                    raise FileNotFoundError(fpath)
+                else:
+                    tokens, size, stamp = marshal.loads(loaded[i])
             except FileNotFoundError:
                 failed.append(fpath)
                 continue
+            self.stamps[fpath] = stamp
+            if self.schema is not None:
+                header = self._readTyped(tokens, header, fpath, size)
+            else:
+                header = self._readTokens(tokens, header, fpath, size)
             
-            with open(fpath) as file:
-
-                for line in file:
-                    line = line.strip()
-                    
-                    if self._isHeader(line):
-                        header = self._headerFromLine(line)
-                        self.raws[header] = {}
-                    elif self._isAttr(line):
-                        name, value = self._attrFromLine(line)
-                        
-                        value = self._handleValue(value, file)
-                            
-                        # Is there more than one attribute with this name?
-                        if name in self.raws[header]:
-                            # If so, convert it into a list
-                            # and append to it from now on.
-                            if name not in self.compounds:
-                                self.compounds.append(name)
-                                original_value = self.raws[header][name]
-                                self.raws[header][name] = []
-                                self.raws[header][name].append(original_value)
-                            self.raws[header][name].append(value)
-                        else:
-                            self.raws[header][name] = value
         for fpath in fpaths:
             if fpath in failed:
                 pass
             else:
                 self.dat_paths.append(fpath)
+        self._rebuildIndexes()
         return failed
         
+    def _tokensFor(self, fpath, raw=False):
+        # Token stream of fpath, from its sidecar when still valid, the
+        # size of the file and its stamp when read. raw streams, for a
+        # schema to decode, have sidecars of their own.
+        cache = self.raw_cache if raw else self.cache
+        stat = os.stat(fpath)
+        if cache is not None:
+            tokens = cache.load(fpath, stat)
+            if tokens is not None:
+                return tokens, stat.st_size, _stamp(stat)
+        
+        with open(fpath, 'rb') as file:
+            data = file.read()
+        tokens = self.tokenizer.tokens(DatLines(data, self.encoding), raw)
+        if cache is not None:
+            tokens = list(tokens)
+            cache.store(fpath, stat, data, tokens)
+        return tokens, len(data), _stamp(stat)
+    
+    def _readTokens(self, tokens, header, fpath=None, size=None):
+        raws = self.raws
+        attrs = raws.get(header)
+        start = None
+        HEADER = DatTokenizer.HEADER
+        for kind, key, value in tokens:
+            if kind == HEADER:
+                if start is not None:
+                    self.spans[header] = (start, value)
+                    self._closeSection(header, attrs)
+                header = key
+                start = value
+                attrs = self._openSection(header, fpath)
+                continue
+            if attrs is None:
+                self._store(header, key, value)
+            elif key in attrs:
+                _storeAttr(attrs, key, value, self.compounds)
+            else:
+                attrs[key] = value
+        if start is not None:
+            self.spans[header] = (start, size)
+            self._closeSection(header, attrs)
+        return header
+    
+    def _readTyped(self, tokens, header, fpath=None, size=None):
+        # _readTokens for a parser with a schema. The type of a section can
+        # come after any of its other attributes, so its tokens are kept
+        # until the next header and then decoded as that type.
+        section = []
+        keep = section.append
+        attrs = None
+        start = None
+        HEADER = DatTokenizer.HEADER
+        for token in tokens:
+            if token[0] != HEADER:
+                keep(token)
+                continue
+            if section:
+                if attrs is None:
+                    attrs = self.raws[header]
+                self._decodeSection(header, attrs, section)
+                section.clear()
+            if start is not None:
+                self.spans[header] = (start, token[2])
+                self._closeSection(header, attrs)
+            header = token[1]
+            start = token[2]
+            attrs = self._openSection(header, fpath)
+        if section:
+            if attrs is None:
+                attrs = self.raws[header]
+            self._decodeSection(header, attrs, section)
+        if start is not None:
+            self.spans[header] = (start, size)
+            self._closeSection(header, attrs)
+        return header
+    
+    def _decodeSection(self, header, attrs, tokens):
+        types = {'type': attrs.get('type', _MISSING),
+            'subtype': attrs.get('subtype', _MISSING)}
+        for kind, key, value in tokens:
+            if key in types:
+                # Given twice it's a compound, which matches no type
+                types[key] = value if types[key] is _MISSING else None
+        type, subtype = [None if value is _MISSING else value
+            for value in (types['type'], types['subtype'])]
+        
+        raw_decoder, decoder = self.schema.decoder(type, subtype)
+        RAW = DatTokenizer.RAW
+        compounds = self.compounds
+        for kind, key, value in tokens:
+            if kind == RAW:
+                decode = raw_decoder.get(key, toScalar)
+            else:
+                decode = decoder.get(key)
+            if decode is not None:
+                try:
+                    value = decode(value)
+                except (TypeError, ValueError):
+                    # The editor writes unset fields as empty values
+                    if value != '':
+                        kind = self.schema.fields(type, subtype)[key]
+                        raise SchemaError(header, key, kind, value)
+            if key in attrs:
+                _storeAttr(attrs, key, value, compounds)
+            else:
+                attrs[key] = value
+    
+    def _openSection(self, header, fpath):
+        # The attrs to read header's section into. A DatColumns only gets
+        # them once the section is complete, see _closeSection().
+        attrs = self.raws[header] = {}
+        if type(self.raws) is DatColumns:
+            attrs = {}
+        self.sources[header] = fpath
+        self.spans[header] = None
+        self.dirty.pop(header, None)
+        return attrs
+    
+    def _closeSection(self, header, attrs):
+        # Pack a section read into a dict of its own into the columns, so
+        # only one section at a time is ever held as a dict
+        if type(self.raws) is DatColumns and type(attrs) is dict:
+            self.raws[header] = attrs
+    
+    def _store(self, header, name, value):
+        _storeAttr(self.raws[header], name, value, self.compounds)
+    
+    def iterparse(self, *fpaths):
+        """Stream (header, attributes) for each section of fpaths without
+        keeping anything in raws, reading one line at a time. Attributes
+        before the first header are yielded under 'global', and a header
+        appearing twice is yielded twice."""
+        
+        header = 'global'
+        attrs = None
+        compounds = []
+        for fpath in fpaths:
+            with open(fpath, 'rb') as file:
+                lines = DatLines(file, self.encoding)
+                for kind, key, value in self.tokenizer.tokens(lines):
+                    if kind == DatTokenizer.HEADER:
+                        if attrs is not None:
+                            yield header, attrs
+                        header = key
+                        attrs = {}
+                    else:
+                        if attrs is None:
+                            attrs = {}
+                        _storeAttr(attrs, key, value, compounds)
+        if attrs is not None:
+            yield header, attrs
+    
+    def _readLegacy(self, file, header, fpath=None):
+        # The original predicate chain, kept for comparison. Compounds are
+        # stored as they always were too, see _storeAttr.
+        for line in file:
+            line = line.strip()
+            
+            if self._isHeader(line):
+                header = self._headerFromLine(line)
+                self._openSection(header, fpath)
+            elif self._isAttr(line):
+                name, value = self._attrFromLine(line)
+                value = self._handleValue(value, file)
+                attrs = self.raws[header]
+                
+                # Is there more than one attribute with this name?
+                if name in attrs:
+                    # If so, convert it into a list
+                    # and append to it from now on.
+                    if name not in self.compounds:
+                        self.compounds.append(name)
+                        original_value = attrs[name]
+                        attrs[name] = []
+                        attrs[name].append(original_value)
+                    attrs[name].append(value)
+                else:
+                    attrs[name] = value
+        return header
+        
+    def _indexKeys(self, header, name):
+        attrs = self.raws[header]
+        if name == 'name':
+            # A GOB is named by its header unless it says otherwise
+            value = attrs.get('name', header)
+        elif name in attrs:
+            value = attrs[name]
+        else:
+            return ()
+        
+        if not isinstance(value, list):
+            value = [value]
+        keys = []
+        for key in value:
+            try:
+                hash(key)
+            except TypeError:
+                continue
+            keys.append(key)
+        return keys
+    
+    def _indexAttr(self, header, name):
+        index = self.indexes[name]
+        for key in self._indexKeys(header, name):
+            index.setdefault(key, {})[header] = None
+    
+    def _unindexAttr(self, header, name):
+        index = self.indexes[name]
+        for key in self._indexKeys(header, name):
+            headers = index.get(key)
+            if headers is not None:
+                headers.pop(header, None)
+                if len(headers) == 0:
+                    del(index[key])
+    
+    def _indexHeader(self, header):
+        if header not in self.order:
+            self.order[header] = self.next_order
+            self.next_order += 1
+        for name in self.indexes:
+            self._indexAttr(header, name)
+            
+    def _unindexHeader(self, header):
+        for name in self.indexes:
+            self._unindexAttr(header, name)
+        self.order.pop(header, None)
+    
+    def _rebuildIndexes(self):
+        for name in self.indexes:
+            self.indexes[name] = {}
+        self.order = {}
+        self.next_order = 0
+        for header in self.raws:
+            self._indexHeader(header)
+    
+    def addIndex(self, name):
+        """Index attribute name from now on. 'name', 'type' and 'subtype'
+        are always indexed; find() adds others on first use."""
+        if name in self.indexes:
+            return False
+        self.indexes[name] = {}
+        for header in self.raws:
+            self._indexAttr(header, name)
+        return True
+    
+    def find(self, **criteria):
+        """Headers of the GOBs matching every criteria, in .DAT order, eg.
+        find(type='actor', subtype=['enemy', 'friendly']). A list of values
+        matches any of them and a list attribute matches any of its items.
+        Only indexes are consulted, so this is O(result) rather than a scan
+        of every GOB. Indexes follow changes made through DatParser's own
+        methods, not changes made directly to raws."""
+        
+        matches = None
+        for name, wanted in criteria.items():
+            self.addIndex(name)
+            index = self.indexes[name]
+            if isinstance(wanted, (list, tuple, set)):
+                found = {}
+                for value in wanted:
+                    found.update(index.get(value, {}))
+            else:
+                found = index.get(wanted, {})
+            
+            if matches is None:
+                matches = found
+            else:
+                if len(found) < len(matches):
+                    matches, found = found, matches
+                matches = {h: None for h in matches if h in found}
+            if len(matches) == 0:
+                return []
+        
+        if matches is None:
+            return list(self.raws)
+        return sorted(matches, key=self.order.__getitem__)
+    
+    def query(self, **criteria):
+        """A DatQuery over the headers find(**criteria) gives, or over
+        every header without criteria."""
+        if criteria:
+            return DatQuery(self, self.find(**criteria))
+        return DatQuery(self)
+    
+    def findGobs(self, **criteria):
+        return [GameObject(h, self.raws[h]) for h in self.find(**criteria)]
+    
+    def getName(self, header):
+        return self.raws[header].get('name', header)
+    
+    def getNames(self):
+        return list(self.indexes['name'])
+        
     def getDatPaths(self):
         return self.dat_paths
         
@@ -159,11 +1012,13 @@ class DatParser(object):
     def getValue(self, header, name):
         return self.raws[header][name]
     
+    def iterGobs(self):
+        """Yield a GameObject view per header without building a list."""
+        for header, attributes in self.raws.items():
+            yield GameObject(header, attributes)
+    
     def getGobs(self):
-        gobs =[]
-        for raw in self.raws:
-            gobs.append(GameObject(raw, self.raws[raw]))
-        return gobs
+        return list(self.iterGobs())
     
     def getGob(self, key):
         if key in self.raws:
@@ -178,13 +1033,35 @@ class DatParser(object):
                 continue
             else:
                 name = attr
-                self.raws[header][name] = gob.getAttr(name)
+                self._setValue(header, name, gob.getAttr(name))
+    
+    def _setValue(self, header, name, value):
+        indexed = name in self.indexes
+        if indexed:
+            self._unindexAttr(header, name)
+        self.raws[header][name] = value
+        if indexed:
+            self._indexAttr(header, name)
+        self.dirty[header] = None
+        
+    def _forget(self, header):
+        # Drop header's section from its file on the next save
+        path = self.sources.pop(header, None)
+        if header in self.spans:
+            self.removed.setdefault(path, []).append(self.spans.pop(header))
+        self.dirty.pop(header, None)
                 
     def updateValue(self, header, name, value):
-        self.raws[header][name] = self._handleValue(value)
+        self._setValue(header, name, self._handleValue(value))
             
     def updateHeader(self, header, new_header):
-        self.raws[new_header] = self.raws.pop[header]
+        path = self.sources.get(header)
+        self._unindexHeader(header)
+        self._forget(header)
+        self.raws[new_header] = self.raws.pop(header)
+        self._indexHeader(new_header)
+        self.sources[new_header] = path
+        self.dirty[new_header] = None
             
     def addHeader(self, header):
         if header in self.raws:
@@ -192,6 +1069,8 @@ class DatParser(object):
             return False
         
         self.raws[header] = {}
+        self._indexHeader(header)
+        self.dirty[header] = None
         
     def addName(self, header, name, value=''):
         if not header in self.raws:
@@ -200,38 +1079,781 @@ class DatParser(object):
         elif name in self.raws[header]:
             self.updateValue(header, name, value)
         
-        self.raws[header][name] = self._handleValue(value)
+        self._setValue(header, name, self._handleValue(value))
             
-    def save(self):
-        for path in self.dat_paths:
-            # Safety first! Backup current.
-            with open(path + '.bak', 'w') as bak:
-                with open(path, 'r') as cur:
-                    bak.write(cur.read())
-                    
-            with open(path, 'w') as dat:
-                for raw in self.raws:
-                    dat.write('[%s]\n' % raw)
-                    for name in self.raws[raw]:
-                        value = self.raws[raw][name]
-                        if isinstance(value, list):
-                            value = '[%s]' % ','.join(value)
-                        dat.write('%s = %s\n' % (name, value))
-                    dat.write('\n\n')
+    def _valueToStr(self, value):
+        if isinstance(value, list):
+            return '[%s]' % ','.join(map(str, value))
+        if isinstance(value, str) and value.find('"') == -1:
+            # Quote values that wouldn't read back as the same string
+            if value.find('\n') != -1 or value.startswith('['):
+                return '"%s"' % value
+        return '%s' % value
+    
+    def _section(self, header):
+        lines = ['[%s]\n' % header]
+        for name, value in self.raws[header].items():
+            lines.append('%s = %s\n' % (name, self._valueToStr(value)))
+        lines.append('\n\n')
+        section = ''.join(lines)
+        if os.linesep != '\n':
+            section = section.replace('\n', os.linesep)
+        return section.encode(self.encoding)
+    
+    def _replace(self, tmp, path):
+        # Safety first! The old file becomes the backup. A hard link
+        # makes that free where the file system allows it.
+        if os.path.exists(path):
+            bak = path + '.bak'
+            if os.path.exists(bak):
+                os.remove(bak)
+            try:
+                os.link(path, bak)
+            except OSError:
+                shutil.copyfile(path, bak)
+        os.replace(tmp, path)
+    
+    def _append(self, path, headers):
+        # New sections go on the end; the file is never rewritten, so
+        # unlike the other saves this isn't atomic, see save()
+        spans = {}
+        with open(path, 'r+b') as dat:
+            end = pos = dat.seek(0, os.SEEK_END)
+            try:
+                if pos > 0:
+                    dat.seek(pos - 1)
+                    if dat.read(1) not in (b'\n', b'\r'):
+                        pos += dat.write(os.linesep.encode(self.encoding))
+                for header in headers:
+                    section = self._section(header)
+                    dat.write(section)
+                    spans[header] = (pos, pos + len(section))
+                    pos += len(section)
+                dat.flush()
+                os.fsync(dat.fileno())
+            except BaseException:
+                # Don't leave part of a section behind
+                dat.truncate(end)
+                raise
+        self.spans.update(spans)
+    
+    def _splice(self, path, headers, removed):
+        # Copy the bytes of untouched sections over as they are and only
+        # write out the sections that changed.
+        edits = [(start, end, b'', None) for start, end in removed]
+        appended = []
+        for header in headers:
+            if header in self.spans:
+                start, end = self.spans[header]
+                edits.append((start, end, self._section(header), header))
+            else:
+                appended.append(header)
+        edits.sort(key=lambda edit: edit[0])
+        
+        tmp = path + '.tmp'
+        ends = []
+        shifts = []
+        shift = 0
+        with open(path, 'rb') as cur, open(tmp, 'wb') as dat:
+            pos = 0
+            for start, end, section, header in edits:
+                cur.seek(pos)
+                self._copy(cur, dat, start - pos)
+                if header is not None:
+                    out = dat.tell()
+                    self.spans[header] = (out, out + len(section))
+                dat.write(section)
+                pos = end
+                shift += len(section) - (end - start)
+                ends.append(end)
+                shifts.append(shift)
+            cur.seek(pos)
+            shutil.copyfileobj(cur, dat)
+            
+            out = dat.tell()
+            for header in appended:
+                section = self._section(header)
+                dat.write(section)
+                self.spans[header] = (out, out + len(section))
+                out += len(section)
+        self._replace(tmp, path)
+        
+        # Everything after an edit moved by the size change of the edits
+        # before it
+        edited = set(headers)
+        for header, span in self.spans.items():
+            if span is None or header in edited:
+                continue
+            if self.sources.get(header) != path:
+                continue
+            i = bisect.bisect_right(ends, span[0])
+            if i > 0:
+                self.spans[header] = (span[0] + shifts[i-1],
+                    span[1] + shifts[i-1])
+    
+    def _copy(self, src, dst, n):
+        while n > 0:
+            chunk = src.read(min(n, 1024 * 1024))
+            if not chunk:
+                break
+            dst.write(chunk)
+            n -= len(chunk)
+    
+    def _current(self, path):
+        # Is path still the file it was when last read or saved? Only
+        # then can its sections be found at the spans recorded.
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return False
+        return _stamp(stat) == self.stamps.get(path)
+    
+    def _rewrite(self, path):
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as dat:
+            pos = 0
+            for header in self.raws:
+                if self.sources.get(header) != path:
+                    continue
+                section = self._section(header)
+                dat.write(section)
+                self.spans[header] = (pos, pos + len(section))
+                pos += len(section)
+        self._replace(tmp, path)
+            
+    def save(self, full=False):
+        """Write changed headers back to the .DAT file each came from; new
+        headers go to the last file read. Sections are located by the byte
+        ranges recorded while reading. Changed or removed sections are
+        saved by copying the untouched sections' bytes to a temporary file
+        that replaces the original, leaving it as .bak. Only added headers
+        means appending to the file in place instead, which skips copying
+        it but isn't atomic: the append is synced to disk and undone if
+        writing fails, but a crash during it can still leave a partial last
+        section, and there's no .bak of it.
+        A full save, a file read by the legacy engine or one changed by
+        someone else since it was read is rewritten from raws, dropping
+        the other changes. Changes made directly to raws need a full save;
+        headers added that way go to the last file read."""
+        
+        paths = list(dict.fromkeys(self.dat_paths))
+        if len(paths) == 0:
+            return False
+        
+        if full:
+            for header in self.raws:
+                if self.sources.get(header) is None:
+                    self.sources[header] = paths[-1]
+        
+        changed = {}
+        for header in self.dirty:
+            path = self.sources.get(header) or paths[-1]
+            self.sources[header] = path
+            changed.setdefault(path, []).append(header)
+            
+        for path in paths:
+            headers = changed.get(path, [])
+            removed = self.removed.get(path, [])
+            if full:
+                self._rewrite(path)
+            elif len(headers) == 0 and len(removed) == 0:
+                continue
+            elif None in removed or any(
+                    header in self.spans and self.spans[header] is None
+                    for header in headers) or not self._current(path):
+                self._rewrite(path)
+            elif len(removed) == 0 and not any(
+                    header in self.spans for header in headers):
+                self._append(path, headers)
+            else:
+                self._splice(path, headers, removed)
+            self.stamps[path] = _stamp(os.stat(path))
+        
+        self.dirty = {}
+        self.removed = {}
+        return True
     
     def delete(self, header):
         if header in self.raws:
+            self._unindexHeader(header)
+            self._forget(header)
             del(self.raws[header])
         self.save()
             
+class MappedDat(object):
+    """Random access to the GOBs of one .DAT file. The file is memory
+    mapped and an index of header -> byte range is built once and kept
+    in a .DATI sidecar, so getGob() only parses the one section asked
+    for. As with read(), a repeated header refers to its last section."""
+    
+    def __init__(self, fpath, encoding=None, persist=True):
+        self.fpath = fpath
+        self.encoding = encoding or locale.getpreferredencoding(False)
+        self.tokenizer = DatTokenizer()
+        self.sidecar = DatCache('I') if persist else None
+        
+        self.file = open(fpath, 'rb')
+        stat = os.fstat(self.file.fileno())
+        if stat.st_size == 0:
+            # Empty files can't be mapped
+            self.map = b''
+        else:
+            self.map = mmap.mmap(self.file.fileno(), 0,
+                access=mmap.ACCESS_READ)
+        
+        self.index = None
+        if self.sidecar is not None:
+            self.index = self.sidecar.load(fpath, stat)
+        if self.index is None:
+            self.index = self._buildIndex()
+            if self.sidecar is not None:
+                self.sidecar.store(fpath, stat, self.map, self.index)
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc):
+        self.close()
+    
+    def _buildIndex(self):
+        index = {}
+        if len(self.map) == 0:
+            return index
+        
+        self.map.seek(0)
+        lines = DatLines(self.map, self.encoding)
+        header = None
+        for kind, key, value in self.tokenizer.tokens(lines):
+            if kind == DatTokenizer.HEADER:
+                if header is not None:
+                    index[header] = (start, value)
+                header = key
+                start = value
+        if header is not None:
+            index[header] = (start, len(self.map))
+        return index
+        
+    def close(self):
+        if isinstance(self.map, mmap.mmap):
+            self.map.close()
+        self.file.close()
+        
+    def getHeaders(self):
+        return list(self.index)
+        
+    def getSpan(self, key):
+        return self.index.get(key)
+        
+    def getRaw(self, key):
+        """The attributes of header key, parsed from its section alone."""
+        if key not in self.index:
+            return None
+        start, end = self.index[key]
+        lines = DatLines(self.map[start:end], self.encoding)
+        attrs = {}
+        compounds = []
+        for kind, name, value in self.tokenizer.tokens(lines):
+            if kind == DatTokenizer.ATTR:
+                _storeAttr(attrs, name, value, compounds)
+        return attrs
+        
+    def getGob(self, key):
+        attrs = self.getRaw(key)
+        if attrs is not None:
+            return GameObject(key, attrs)
+            
+
+def _stamp(stat):
+    # What tells a file apart from the one save() last read or wrote
+    return stat.st_size, stat.st_mtime_ns
+
+
+def _loadTokens(fpath, encoding, cache, raw):
+    # DatParser.read's worker: the tokens of one file, its size and
+    # stamp, or None when it doesn't exist. marshal is much quicker than
+    # the pickling the pool would otherwise do on the way back.
+    parser = DatParser(cache=cache)
+    parser.encoding = encoding
+    try:
+        tokens, size, stamp = parser._tokensFor(fpath, raw)
+    except FileNotFoundError:
+        return None
+    return marshal.dumps((list(tokens), size, stamp))
+    
+    
+class DatQuery(object):
+    """Bulk queries over the GOBs of a DatParser, working through whole
+    attribute columns at once instead of a GameObject at a time:
+    
+        parser.query(type='item').where('weight', '>', 10).sortBy('attack')
+        parser.query(type='actor').groupBy('subtype', 'health', 'mean')
+    
+    where() and sortBy() return a narrowed or reordered query, while
+    getHeaders(), values(), array() and groupBy() give results. Numeric
+    work is done with numpy when it's installed."""
+    
+    OPS = {
+        '==': operator.eq, '!=': operator.ne,
+        '<': operator.lt, '<=': operator.le,
+        '>': operator.gt, '>=': operator.ge,
+        'in': lambda value, within: value in within,
+        'has': lambda value, item: isinstance(value, list) and item in value,
+        }
+    AGGREGATES = ('count', 'sum', 'mean', 'min', 'max')
+    
+    def __init__(self, parser, headers=None):
+        self.parser = parser
+        if headers is None:
+            headers = parser.getRaws()
+        self.headers = list(headers)
+    
+    def __len__(self):
+        return len(self.headers)
+    
+    def __iter__(self):
+        return iter(self.headers)
+    
+    def getHeaders(self):
+        return list(self.headers)
+    
+    def values(self, name, default=None):
+        """name's value for each header, or default where it has none."""
+        raws = self.parser.getRaws()
+        if isinstance(raws, DatColumns):
+            column = raws.columns.get(name)
+            if column is None:
+                return [default] * len(self.headers)
+            shapes = raws.shapes
+            return [column[row] if name in shapes[row] else default
+                for row in map(raws.rows.__getitem__, self.headers)]
+        return [raws[header].get(name, default) for header in self.headers]
+    
+    def array(self, name):
+        """name's numeric value for each header as floats, NaN where it has
+        none: a numpy array when numpy is installed, else an array('d')."""
+        raws = self.parser.getRaws()
+        column = None
+        if isinstance(raws, DatColumns):
+            column = raws.columns.get(name)
+        if numpy is not None and type(column) is array:
+            # Numeric columns are read in place
+            shapes = raws.shapes
+            rows = numpy.fromiter(map(raws.rows.__getitem__, self.headers),
+                numpy.intp, len(self.headers))
+            present = numpy.fromiter((name in shapes[row] for row in rows),
+                bool, len(rows))
+            # A column only reaches as far as the last row having name, so
+            # only the rows that have it are read
+            values = numpy.full(len(rows), numpy.nan)
+            values[present] = numpy.frombuffer(column,
+                column.typecode)[rows[present]]
+            return values
+    
+        nan = float('nan')
+        values = [value if type(value) in (int, float) else nan
+            for value in self.values(name)]
+        if numpy is not None:
+            return numpy.array(values, float)
+        return array('d', values)
+    
+    def _select(self, mask):
+        return DatQuery(self.parser, compress(self.headers, mask))
+    
+    def where(self, name, op, value):
+        """The headers whose name compares to value with op, one of
+        ==, !=, <, <=, >, >=, in (value is a collection) and has (name is a
+        list holding value). Numbers are compared as columns; headers
+        missing name never match."""
+        compare = self.OPS[op]
+        numeric = type(value) in (int, float) and op not in ('in', 'has')
+        if numeric:
+            values = self.array(name)
+            if numpy is not None:
+                mask = compare(values, value) & ~numpy.isnan(values)
+            else:
+                mask = [v == v and compare(v, value) for v in values]
+            return self._select(mask)
+    
+        mask = []
+        for v in self.values(name, _MISSING):
+            try:
+                mask.append(v is not _MISSING and bool(compare(v, value)))
+            except TypeError:
+                mask.append(False)
+        return self._select(mask)
+    
+    def sortBy(self, name, reverse=False):
+        """The headers ordered by their number for name, with those having
+        none last and ties kept in order. When no header has a number for
+        name, they're ordered by the text of its value instead."""
+        values = self.array(name)
+        n = len(self.headers)
+        if numpy is not None:
+            known = numpy.flatnonzero(~numpy.isnan(values))
+            keys = -values[known] if reverse else values[known]
+            order = known[numpy.argsort(keys, kind='stable')].tolist()
+            order.extend(numpy.flatnonzero(numpy.isnan(values)).tolist())
+        else:
+            known = [i for i in range(n) if values[i] == values[i]]
+            order = sorted(known, key=values.__getitem__, reverse=reverse)
+            order.extend(i for i in range(n) if values[i] != values[i])
+        
+        if n and not len(known):
+            texts = self.values(name, _MISSING)
+            order = sorted((i for i in range(n) if texts[i] is not _MISSING),
+                key=lambda i: str(texts[i]), reverse=reverse)
+            order.extend(i for i in range(n) if texts[i] is _MISSING)
+        return DatQuery(self.parser, [self.headers[i] for i in order])
+    
+    def groupBy(self, key, name=None, aggregate='count'):
+        """{value of key: aggregate of name} over the headers having each
+        value of key, eg. groupBy('subtype', 'health', 'mean'). aggregate
+        is count, sum, mean, min or max; without name, count counts the
+        headers. Headers whose name isn't a number are left out."""
+        if aggregate not in self.AGGREGATES:
+            raise ValueError('unknown aggregate %r' % aggregate)
+        groups = {}
+        codes = []
+        for value in self.values(key):
+            if isinstance(value, list):
+                value = tuple(value)
+            codes.append(groups.setdefault(value, len(groups)))
+        if name is None:
+            if aggregate != 'count':
+                raise ValueError('%s needs an attribute' % aggregate)
+            counts = [0] * len(groups)
+            for code in codes:
+                counts[code] += 1
+            return dict(zip(groups, counts))
+    
+        values = self.array(name)
+        if numpy is not None:
+            codes = numpy.array(codes, numpy.intp)
+            known = ~numpy.isnan(values)
+            codes, values = codes[known], values[known]
+            counts = numpy.bincount(codes, minlength=len(groups))
+            if aggregate in ('sum', 'mean'):
+                results = numpy.bincount(codes, values, len(groups))
+                if aggregate == 'mean':
+                    with numpy.errstate(invalid='ignore', divide='ignore'):
+                        results = results / counts
+            elif aggregate == 'count':
+                results = counts
+            else:
+                fill = numpy.inf if aggregate == 'min' else -numpy.inf
+                results = numpy.full(len(groups), fill)
+                ufunc = numpy.minimum if aggregate == 'min' else numpy.maximum
+                ufunc.at(results, codes, values)
+            if aggregate != 'count':
+                results = [result if count else None for result, count
+                    in zip(results.tolist(), counts.tolist())]
+            else:
+                results = results.tolist()
+            return dict(zip(groups, results))
+    
+        results = [None] * len(groups)
+        counts = [0] * len(groups)
+        for code, value in zip(codes, values):
+            if value != value:
+                continue
+            counts[code] += 1
+            result = results[code]
+            if result is None:
+                results[code] = value
+            elif aggregate in ('sum', 'mean'):
+                results[code] = result + value
+            elif aggregate == 'min':
+                results[code] = min(result, value)
+            elif aggregate == 'max':
+                results[code] = max(result, value)
+        if aggregate == 'count':
+            results = counts
+        elif aggregate == 'mean':
+            results = [None if result is None else result / count
+                for result, count in zip(results, counts)]
+        return dict(zip(groups, results))
+
+
+class DatLinker(object):
+    """Links the GOBs of one or more parsers by name. Every name is
+    interned, each attribute the schema declares as 'refs' is resolved to
+    the GameObjects it names and a reverse index records who refers to
+    whom, so none of it has to be looked up again by scanning files.
+    References to names that don't exist are collected in dangling as
+    (name, attribute, missing name) when linking."""
+    
+    def __init__(self, *parsers, schema=None):
+        self.schema = schema or default_schema
+        self.gobs = {}
+        self.links = {}
+        self.referrers = {}
+        self.dangling = []
+        if parsers:
+            self.link(*parsers)
+    
+    def _refValues(self, value):
+        # The names in a refs value, which may have been repeated into a
+        # compound or written without brackets
+        if isinstance(value, str):
+            value = [value]
+        elif not isinstance(value, list):
+            return
+        for item in value:
+            if isinstance(item, list):
+                for name in self._refValues(item):
+                    yield name
+            elif isinstance(item, str) and item:
+                yield sys.intern(item)
+    
+    def link(self, *parsers):
+        """Index the GOBs of parsers, later ones taking a name from earlier
+        ones, and resolve their references. Returns dangling."""
+        gobs = {}
+        for parser in parsers:
+            for header in parser.getRaws():
+                name = sys.intern(str(parser.getName(header)))
+                gobs[name] = parser.getGob(header)
+    
+        links = {}
+        referrers = {}
+        dangling = []
+        schema = self.schema
+        for name, gob in gobs.items():
+            attrs = gob._attributes
+            for attr in schema.refs(attrs.get('type'), attrs.get('subtype')):
+                if attr not in attrs:
+                    continue
+                targets = []
+                for ref in self._refValues(attrs[attr]):
+                    target = gobs.get(ref)
+                    if target is None:
+                        dangling.append((name, attr, ref))
+                        continue
+                    targets.append(target)
+                    referrers.setdefault(ref, {})[name, attr] = None
+                links.setdefault(name, {})[attr] = targets
+    
+        self.gobs = gobs
+        self.links = links
+        self.referrers = referrers
+        self.dangling = dangling
+        return dangling
+    
+    def __contains__(self, name):
+        return name in self.gobs
+    
+    def get(self, name):
+        """The GameObject called name, or None."""
+        return self.gobs.get(name)
+    
+    def getNames(self):
+        return self.gobs.keys()
+    
+    def refs(self, name, attr):
+        """The GameObjects name's attr refers to, skipping dangling ones."""
+        return self.links.get(name, {}).get(attr, [])
+    
+    def referring(self, name, attr=None, type=None):
+        """Names of the GOBs referring to name, only through attr and only
+        of type when given, eg. referring('template key', 'items', 'room')
+        for the rooms holding a template key."""
+        found = []
+        for referrer, via in self.referrers.get(name, {}):
+            if attr is not None and via != attr:
+                continue
+            if type is not None and self.gobs[referrer].getAttr('type') != type:
+                continue
+            if referrer not in found:
+                found.append(referrer)
+        return found
+
+
+class DatRegistry(object):
+    """A process wide collection of parsed .DAT files. Everyone asking for
+    the same file shares one DatParser, which is only read again once the
+    file on disk changes. acquire() and release() keep a reference count
+    per file, and callbacks given to subscribe() are called as
+    callback(path, parser) whenever a file has been read again.
+    linker() keeps a DatLinker for a set of files until one of them
+    changes."""
+    
+    def __init__(self):
+        self.parsers = {}
+        self.stamps = {}
+        self.refs = {}
+        self.listeners = {}
+        self.name_sets = {}
+        self.linkers = {}
+        
+    def _key(self, path):
+        return os.path.normcase(os.path.abspath(path))
+        
+    def _stamp(self, key):
+        try:
+            stat = os.stat(key)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+        
+    def _load(self, key):
+        # Stamp first, so a write during the read shows up as a change
+        self.stamps[key] = self._stamp(key)
+        parser = DatParser()
+        parser.read(key)
+        self.parsers[key] = parser
+        self._changed(key)
+        return parser
+    
+    def _changed(self, key):
+        # Forget what was worked out from the file at key
+        self.name_sets.pop(key, None)
+        for keys in list(self.linkers):
+            if key in keys:
+                del(self.linkers[keys])
+    
+    def _notify(self, key, parser):
+        for callback in list(self.listeners.get(key, [])):
+            callback(key, parser)
+    
+    def get(self, path):
+        """The shared DatParser for path, read again if the file changed
+        since it was last read."""
+        key = self._key(path)
+        parser = self.parsers.get(key)
+        if parser is None:
+            return self._load(key)
+        if self._stamp(key) != self.stamps[key]:
+            parser = self._load(key)
+            self._notify(key, parser)
+        return parser
+    
+    def refresh(self, path):
+        """Read path again whether or not it changed, eg. after saving."""
+        key = self._key(path)
+        parser = self._load(key)
+        self._notify(key, parser)
+        return parser
+        
+    def saved(self, path):
+        """Note that path was just written by its shared parser, which is
+        already up to date, and tell subscribers about it."""
+        key = self._key(path)
+        parser = self.parsers.get(key)
+        if parser is None:
+            return self.refresh(key)
+        self.stamps[key] = self._stamp(key)
+        self._changed(key)
+        self._notify(key, parser)
+        return parser
+        
+    def acquire(self, path):
+        key = self._key(path)
+        self.refs[key] = self.refs.get(key, 0) + 1
+        return self.get(key)
+        
+    def release(self, path):
+        key = self._key(path)
+        if key not in self.refs:
+            return False
+        self.refs[key] -= 1
+        if self.refs[key] <= 0:
+            del(self.refs[key])
+            self.parsers.pop(key, None)
+            self.stamps.pop(key, None)
+            self._changed(key)
+        return True
+    
+    def subscribe(self, path, callback):
+        self.listeners.setdefault(self._key(path), []).append(callback)
+        
+    def unsubscribe(self, path, callback):
+        callbacks = self.listeners.get(self._key(path), [])
+        if callback in callbacks:
+            callbacks.remove(callback)
+        
+    def iterGobs(self, *paths):
+        for path in paths:
+            for gob in self.get(path).iterGobs():
+                yield gob
+        
+    def getGobs(self, *paths):
+        return list(self.iterGobs(*paths))
+        
+    def names(self, *paths):
+        """The set of GOB names found in paths."""
+        names = set()
+        for path in paths:
+            key = self._key(path)
+            parser = self.get(key)
+            if key not in self.name_sets:
+                self.name_sets[key] = set(parser.getNames())
+            names |= self.name_sets[key]
+        return names
+        
+    def linker(self, *paths, schema=None):
+        """A DatLinker over paths, linked again once any of them changes
+        or is released. Its dangling references are only worked out when
+        it's made. A file named more than once is linked once."""
+        keys = tuple(dict.fromkeys(self._key(path) for path in paths))
+        keys += (schema,)
+        parsers = [self.get(key) for key in keys[:-1]]
+        linker = self.linkers.get(keys)
+        if linker is None:
+            linker = self.linkers[keys] = DatLinker(*parsers, schema=schema)
+        return linker
+
+
+registry = DatRegistry()
+            
 class GameObject(object):
+    """A view of a GOB. Attributes are read through to the dict given
+    (usually an entry of DatParser.raws) instead of being copied. The
+    first write to a GameObject, or a call to materialize(), gives it a
+    private copy so the dict it came from is never changed."""
+    
+    __slots__ = ('_header', '_attributes', '_owned')
+    
     def __init__(self, name, attributes):
-        self.name = name
-        for attr in attributes:
-            setattr(self, attr, attributes[attr])
+        object.__setattr__(self, '_header', name)
+        object.__setattr__(self, '_attributes', attributes)
+        object.__setattr__(self, '_owned', False)
+        
+    def __getattr__(self, key):
+        # Only reached when key isn't a slot or method
+        if key in GameObject.__slots__:
+            raise AttributeError(key)
+        if key == 'name':
+            return self._attributes.get('name', self._header)
+        try:
+            return self._attributes[key]
+        except KeyError:
+            raise AttributeError(key)
+            
+    def __setattr__(self, key, value):
+        self.materialize()
+        self._attributes[key] = value
+        
+    def __delattr__(self, key):
+        self.materialize()
+        try:
+            del(self._attributes[key])
+        except KeyError:
+            raise AttributeError(key)
+    
+    def __reduce__(self):
+        return (GameObject, (self._header, self._attributes))
+    
+    def materialize(self):
+        """Detach from the underlying dict by copying it."""
+        if not self._owned:
+            object.__setattr__(self, '_attributes', dict(self._attributes))
+            object.__setattr__(self, '_owned', True)
+        return self
             
     def getAttributes(self):
-        return self.__dict__
+        attributes = {'name': self.name}
+        attributes.update(self._attributes)
+        return attributes
         
     def getAttr(self, key):
         return getattr(self, key, False)
@@ -240,10 +1862,9 @@ class GameObject(object):
 def main():
     datparser = DatParser()
     datparser.read('data/CONVERSATIONS.DAT')
-    gobs = datparser.getGobs()
     print('Getting GOBs from  the following .DAT files: %s\n'
         % datparser.getDatNames())
-    for gob in gobs:
+    for gob in datparser.iterGobs():
         print('GOB: %s\n%s\n\n' % (gob.getAttr('name'), gob.getAttributes()))
         
 if __name__ == '__main__':
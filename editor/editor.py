@@ -1,3 +1,4 @@
+import glob
 import os
 import sys
 import tkinter as tk
@@ -12,7 +13,7 @@ data_path = project_path + '/data'
 # Only importable if project directory is part of sys path
 from general import peel, isIn, isNum, toNum
 from tkonsole.tkonsole import OutputBox
-from datparser import DatParser
+from datparser import DatParser, registry
     
 class Field(tk.Frame):
     """A Base field class intended to be sub-classed"""
@@ -490,17 +491,16 @@ class SelectionField(Field):
     def __init__(self, master=None, cnf={}, **kw):
         omwidth = kw.pop('omwidth', 10)
         omheight = kw.pop('omheight', 1)
-        OPTIONS = kw.pop('options', ['None'])
-        datpaths = kw.pop('datpaths', [])
-        valid_selections = kw.pop('valid_selections', [])
+        self.base_options = kw.pop('options', ['None'])
+        self.datpaths = kw.pop('datpaths', [])
+        self.valid_selections = kw.pop('valid_selections', [])
 
-        parser = DatParser()
-        parser.read(*datpaths)
-        for gob in parser.getGobs():
-            if len(valid_selections) != 0:
-                if not gob.getAttr('subtype') in valid_selections:
-                    continue
-            OPTIONS.append(gob.getAttr('name'))
+        # The parsed .DATs are shared through the registry, which tells us
+        # when one of them has been read again.
+        for path in self.datpaths:
+            registry.acquire(path)
+            registry.subscribe(path, self._onDatChanged)
+        OPTIONS = self._options()
             
         Field.__init__(self, master, cnf, **kw)
         self.om_VAR = tk.StringVar(self)
@@ -509,6 +509,33 @@ class SelectionField(Field):
         self.om.config(width=omwidth, height=omheight)
         self.om.grid(row=0, column=1, stick='ew')
         
+    def _options(self):
+        """The base options followed by the names of GOBs in self.datpaths
+        that are of a valid subtype."""
+        
+        options = list(self.base_options)
+        for path in self.datpaths:
+            parser = registry.get(path)
+            if len(self.valid_selections) != 0:
+                headers = parser.find(subtype=self.valid_selections)
+            else:
+                headers = parser.find()
+            options.extend(parser.getName(header) for header in headers)
+        return options
+        
+    def _onDatChanged(self, path, parser):
+        """Rebuild the options after one of self.datpaths was read again."""
+        
+        self.om['menu'].delete(0, 'end')
+        for label in self._options():
+            self.add_option(label)
+            
+    def destroy(self):
+        for path in self.datpaths:
+            registry.unsubscribe(path, self._onDatChanged)
+            registry.release(path)
+        Field.destroy(self)
+        
     def add_option(self, label=''):
         """Add an option to the associated tk.OptionMenu."""
         
@@ -602,6 +629,8 @@ class ListWindow(tk.Toplevel):
         tk.Toplevel.__init__(self, master, cnf, **kw)
         self.title(title)
         self.protocol('WM_DELETE_WINDOW', self._onclose)
+        for path in self.datpaths:
+            registry.acquire(path)
         self.textual = None
         self.fields = []
         
@@ -676,6 +705,11 @@ class ListWindow(tk.Toplevel):
         self._stopPolling()
         self.destroy()
         
+    def destroy(self):
+        for path in self.datpaths:
+            registry.release(path)
+        tk.Toplevel.destroy(self)
+        
     def _stopPolling(self):
         """Stop updating/setting the connected entry i/o widget with
         the value created within the self.pollSet() method."""
@@ -808,11 +842,8 @@ class ListWindow(tk.Toplevel):
         # stop polling setter
         self._stopPolling()
         s = str(s)
-        parser = DatParser()
-        parser.read(*self.datpaths)
-        gob_names = [gob.getAttr('name') for gob in parser.getGobs()]
         
-        if s in gob_names:
+        if s in registry.names(*self.datpaths):
             self.addSelection(s)
         elif s.find('|+|') != -1:
             self.addCompound(s)
@@ -991,7 +1022,7 @@ class Editor(object):
         
     def _update_fields(self):
         for field in self.fields:
-            field.grid_remove()
+            field.destroy()
         del(self.fields)
         self.fields = []
             
@@ -1242,11 +1273,7 @@ class Editor(object):
         self.om_gobs. Read the .DAT found via self.dat_path and find a gob
         with the same name. Load the gob into the currently visiable fields."""
         
-        parser = DatParser()
-        parser.read(self.dat_path)
         name = self.om_gobs_VAR.get()
-        gobs = parser.getGobs()
-        found = False
         subtype = None
 
         if self.om_gobs_VAR.get() == '':
@@ -1254,15 +1281,13 @@ class Editor(object):
                 field.set('')
             return None
         
+        parser = registry.get(self.dat_path)
         self.obox.addOutput('Loading GOB: %s' % name)
         
-        for gob in gobs:
-            if gob.getAttr('name') == name:
-                
-                found = gob
-        
-        if not found:
+        headers = parser.find(name=name)
+        if len(headers) == 0:
             return False
+        found = parser.getGob(headers[-1])
             
         if hasattr(found, 'subtype'):
             subtype = found.getAttr('subtype')
@@ -1292,21 +1317,17 @@ class Editor(object):
         self.file_entry.delete(0, 'end')
         self.file_entry.insert(0, path)
         
-        parser = DatParser()
-        failed = parser.read(path)
-        # parser.read() method returns a list of file paths that failed to open
-        for failure in failed:
-            self.obox.addOutput("Failed to open: '%s'" % failure)
+        parser = registry.acquire(path)
+        # A parser that failed to read its file holds no dat paths
+        if len(parser.getDatPaths()) == 0:
+            self.obox.addOutput("Failed to open: '%s'" % path)
         
+        if self.dat_path != '':
+            registry.release(self.dat_path)
         self.dat_path = path
         
-        gobs = parser.getGobs()
-        
-        if len(gobs) != 0:
+        if len(parser.getRaws()) != 0:
             self.om_gobs['menu'].delete(0, 'end')
-            self.om_gobs_VAR.set(
-                gobs[0].getAttr('name')
-            )
             
         # Empty GOB selection option
         self.om_gobs['menu'].add_command(
@@ -1317,7 +1338,7 @@ class Editor(object):
         self.om_gobs_VAR.set('')
         
         # Add all located GOBs to selection
-        for gob in gobs:
+        for gob in parser.iterGobs():
             name = gob.getAttr('name')
             self.om_gobs['menu'].add_command(
                 label=name,
@@ -1326,8 +1347,28 @@ class Editor(object):
                 self._load_gob))
             self.obox.addOutput('GOB Added: ' + gob.getAttr('name'))
         
+        self._report_dangling(path)
         self.obox.addOutput("File loaded succesfully!")
         self._load_gob()
+        
+    def _report_dangling(self, path):
+        """Report references from the GOBs of path to GOBs that aren't in
+        any of the data files."""
+        
+        paths = glob.glob(data_path + '/*.DAT') + [path]
+        # Held only while linking, so the other files aren't kept loaded
+        for p in paths:
+            registry.acquire(p)
+        try:
+            names = set(registry.get(path).getNames())
+            dangling = registry.linker(*paths).dangling
+        finally:
+            for p in paths:
+                registry.release(p)
+        for name, attr, ref in dangling:
+            if name in names:
+                self.obox.addOutput("%s: %s refers to missing GOB '%s'" % (
+                    name, attr, ref))
     
     def save(self):
         """Save the current gob to the current .DAT. If no current .DAT,
@@ -1338,8 +1379,7 @@ class Editor(object):
                 pass
             if self.dat_path != '':
                 self.obox.addOutput('Saving...')
-                parser = DatParser()
-                parser.read(self.dat_path)
+                parser = registry.get(self.dat_path)
             else:
                 self.save_as()
                 return None
@@ -1395,11 +1435,9 @@ class Editor(object):
         self.om_gobs_VAR.set(header)
         self.obox.addOutput('Updating fields...')
         
-        # Currently I update fields to make sure SelectionFields have relevent
-        # info. It's quick and dirty and shouldn't be hard to implement
-        # something cleaner. 
-        #( _update_fields() causes window to twitch when called. Not pretty. )
-        self._update_fields()
+        # Lets every SelectionField subscribed to the file through the
+        # registry pick up the new GOB.
+        registry.saved(self.dat_path)
         
         self.obox.addOutput('Saved!')
         
@@ -1411,9 +1449,12 @@ class Editor(object):
             return None
         if not path.endswith('.DAT'):
             path += '.DAT'
-        self.dat_path = path
         with open(path, 'w'):
             pass
+        if self.dat_path != '':
+            registry.release(self.dat_path)
+        registry.acquire(path)
+        self.dat_path = path
         self.obox.addOutput('Created %s' % os.path.basename(path))
         self.file_entry.delete(0, 'end')
         self.file_entry.insert(0, path)
@@ -1434,14 +1475,12 @@ class Editor(object):
        
         self.obox.addOutput('Deleting %s...' % selected)
         
-        parser = DatParser()
-        parser.read(self.dat_path)
-            
+        parser = registry.get(self.dat_path)
         parser.delete(selected)
-        gobs = parser.getGobs()
+        registry.saved(self.dat_path)
         
         self.om_gobs['menu'].delete(1, 'end')
-        for gob in parser.getGobs():
+        for gob in registry.iterGobs(self.dat_path):
             name = gob.getAttr('name')
             self.om_gobs['menu'].add_command(
                 label=name,
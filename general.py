@@ -1,3 +1,7 @@
+# First characters a number may start with (int() and float() also
+# allow leading whitespace). Any other ASCII character means a string.
+NUM_LEADS = frozenset('+-.0123456789 \t\n\r\f\v')
+
 def isIn(s, l, r):
 	s = s.strip()
 	if s.startswith(l) and s.endswith(r):
@@ -44,15 +48,23 @@ def isNum(s):
 	else:
 		return False
 
-def toNum(s):
-	if isNum(s):
-		pass
-	else:
+def toScalar(s):
+	"""Convert s to an int or float in a single pass, leaving it a string
+	if it's neither. Same results as the isNum() cascade toNum() used to
+	run: a float has exactly one '.', anything int() takes is an int."""
+	lead = s[:1]
+	if lead not in NUM_LEADS and lead.isascii():
 		return s
-		
-	if isFloat(s):
-		return float(s)
-	elif isInt(s):
+	
+	if s.count('.') == 1:
+		try:
+			return float(s)
+		except ValueError:
+			return s
+	try:
 		return int(s)
-	else:
-		return False
\ No newline at end of file
+	except ValueError:
+		return s
+
+def toNum(s):
+	return toScalar(s)
\ No newline at end of file
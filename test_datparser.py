@@ -0,0 +1,274 @@
+"""Tests for DatParser. Run with python -m unittest (or pytest) from the
+directory holding datparser.py."""
+
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import datparser
+from datparser import DatCache, DatParser, DatTokenizer, default_schema
+
+DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+
+
+def _reread(path, **kw):
+    parser = DatParser(cache=False, **kw)
+    parser.read(path)
+    return parser
+
+
+class CompoundTest(unittest.TestCase):
+    """A name given more than once in a header becomes a list of its
+    values, in every header it's repeated in."""
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='datparser')
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.path = os.path.join(self.dir, 'EFFECTS.DAT')
+        with open(self.path, 'w') as dat:
+            dat.write('[burn]\neffect = hot\neffect = [a,b]\n'
+                '[freeze]\neffect = cold\n'
+                '[shock]\neffect = zap\neffect = 2\neffect = "x, y"\n')
+        self.expected = {
+            'burn': {'effect': ['hot', ['a', 'b']]},
+            'freeze': {'effect': 'cold'},
+            'shock': {'effect': ['zap', 2, 'x, y']},
+            }
+
+    def test_token_engine(self):
+        for kw in ({}, {'columnar': True}, {'schema': default_schema}):
+            parser = _reread(self.path, **kw)
+            self.assertEqual(dict((header, dict(attrs))
+                for header, attrs in parser.raws.items()), self.expected)
+            self.assertEqual(parser.compounds, ['effect'])
+
+    def test_iterparse(self):
+        self.assertEqual(dict(DatParser().iterparse(self.path)),
+            self.expected)
+
+    def test_legacy_engine(self):
+        # Kept as it always was for comparison, failing on the repeat
+        with self.assertRaises(AttributeError):
+            _reread(self.path, engine='legacy')
+
+
+class SaveTest(unittest.TestCase):
+    """save() splicing, appending and renaming sections in place, and
+    falling back to a rewrite when it can't trust what it read."""
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='datparser')
+        self.path = os.path.join(self.dir, 'ACTORS.DAT')
+        shutil.copyfile(os.path.join(DATA, 'ACTORS.DAT'), self.path)
+        self.parser = _reread(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def assertSaved(self):
+        self.assertEqual(dict(_reread(self.path).raws), dict(self.parser.raws))
+
+    def _prepend(self, data):
+        with open(self.path, 'rb') as dat:
+            old = dat.read()
+        with open(self.path, 'wb') as dat:
+            dat.write(data + old)
+
+    def test_splice(self):
+        self.parser.updateValue('Burnt', 'health', '5')
+        self.parser.save()
+        self.assertEqual(_reread(self.path).getValue('Burnt', 'health'), 5)
+        self.assertSaved()
+        self.assertTrue(os.path.exists(self.path + '.bak'))
+
+    def test_append(self):
+        with open(self.path, 'rb') as dat:
+            old = dat.read()
+        self.parser.addHeader('Singed')
+        self.parser.addName('Singed', 'health', '7')
+        self.parser.save()
+        with open(self.path, 'rb') as dat:
+            self.assertTrue(dat.read().startswith(old))
+        self.assertSaved()
+
+    def test_rename(self):
+        attrs = dict(self.parser.raws['Burnt'])
+        self.parser.updateHeader('Burnt', 'Scorched')
+        self.parser.save()
+        reread = _reread(self.path)
+        self.assertNotIn('Burnt', reread.raws)
+        self.assertEqual(dict(reread.raws['Scorched']), attrs)
+        self.assertSaved()
+
+    def test_delete(self):
+        self.parser.delete('Burnt')
+        self.assertNotIn('Burnt', _reread(self.path).raws)
+        self.assertSaved()
+
+    def test_saves_in_a_row(self):
+        # Every save leaves spans matching the file it wrote
+        self.parser.updateValue('Burnt', 'desc', 'A much longer description.')
+        self.parser.save()
+        self.parser.addHeader('Singed')
+        self.parser.save()
+        self.parser.updateValue('template party', 'health', '90')
+        self.parser.updateHeader('template enemy', 'template foe')
+        self.parser.save()
+        self.assertSaved()
+
+    def test_edit_after_outside_change(self):
+        # Offsets read before the file changed would splice into the
+        # middle of another section
+        self._prepend(b'[Outside]\nname = Outside\n\n')
+        self.parser.updateValue('Burnt', 'health', '5')
+        self.parser.save()
+        self.assertSaved()
+
+    def test_append_after_outside_change(self):
+        self._prepend(b'[Outside]\nname = Outside\n\n')
+        self.parser.addHeader('Singed')
+        self.parser.save()
+        self.assertSaved()
+
+    def test_full_save_keeps_headers_added_to_raws(self):
+        self.parser.raws['direct'] = {'name': 'direct', 'health': 3}
+        self.parser.save(full=True)
+        self.assertEqual(dict(_reread(self.path).raws['direct']),
+            {'name': 'direct', 'health': 3})
+        self.assertSaved()
+
+
+class ColumnarTest(unittest.TestCase):
+    """A columnar parser reads the same raws as a plain one."""
+
+    def assertSameRead(self, *paths, **kw):
+        plain, columnar = [DatParser(cache=False, columnar=columnar, **kw)
+            for columnar in (False, True)]
+        plain.read(*paths)
+        columnar.read(*paths)
+        self.assertEqual(list(columnar.raws), list(plain.raws))
+        for header in plain.raws:
+            self.assertEqual(dict(columnar.raws[header]), plain.raws[header])
+        self.assertEqual(columnar.spans, plain.spans)
+
+    def test_data(self):
+        paths = sorted(os.path.join(DATA, name) for name in os.listdir(DATA)
+            if name.endswith('.DAT'))
+        self.assertSameRead(*paths)
+        self.assertSameRead(*paths, schema=default_schema)
+        self.assertSameRead(*paths, engine='legacy')
+
+    def test_sections_across_files(self):
+        # Attributes before a file's first header belong to the last
+        # header of the one before; a header read again is replaced
+        tmp = tempfile.mkdtemp(prefix='datparser')
+        self.addCleanup(shutil.rmtree, tmp)
+        paths = [os.path.join(tmp, name) for name in ('1.DAT', '2.DAT')]
+        with open(paths[0], 'w') as dat:
+            dat.write('[A]\nx = 1\nx = 2\ny = [a,b]\n[B]\nx = 3\n')
+        with open(paths[1], 'w') as dat:
+            dat.write('z = 9\n[A]\ny = 1.5\n[C]\ntype = actor\n')
+        self.assertSameRead(*paths)
+        self.assertSameRead(*paths, schema=default_schema)
+
+
+class SchemaTest(unittest.TestCase):
+    """Typed and generic reads of the same files agree whether they come
+    from the files, their sidecars or worker processes."""
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='datparser')
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.paths = [os.path.join(self.dir, name)
+            for name in ('a.DAT', 'b.DAT')]
+        with open(self.paths[0], 'w') as dat:
+            dat.write('[knife]\nname = 007\ntype = item\ndesc = 1.50\n'
+                'weight = 1.50\n')
+        with open(self.paths[1], 'w') as dat:
+            dat.write('[fork]\nname = 42\ntype = item\nweight = 3\n')
+
+    def read(self, workers=None, **kw):
+        parser = DatParser(**kw)
+        parser.read(*self.paths, workers=workers)
+        return dict((header, dict(attrs))
+            for header, attrs in parser.raws.items())
+
+    def test_values(self):
+        typed = self.read(cache=False, schema=default_schema)
+        self.assertEqual(typed['knife'], {'name': '007', 'type': 'item',
+            'desc': '1.50', 'weight': 1.5})
+        generic = self.read(cache=False)
+        self.assertEqual(generic['knife']['name'], 7)
+
+    def test_sidecars(self):
+        typed = self.read(cache=False, schema=default_schema)
+        generic = self.read(cache=False)
+        # Written on the first read, read back on the second
+        for _ in range(2):
+            self.assertEqual(self.read(schema=default_schema), typed)
+            self.assertEqual(self.read(), generic)
+        path = self.paths[0]
+        kinds = set(kind for kind, key, value
+            in DatCache().load(path, os.stat(path)))
+        self.assertNotIn(DatTokenizer.RAW, kinds)
+        self.assertTrue(os.path.exists(path + 'R'))
+
+    def test_workers(self):
+        typed = self.read(cache=False, schema=default_schema)
+        generic = self.read(cache=False)
+        for cache in (False, True, True):
+            self.assertEqual(self.read(2, cache=cache,
+                schema=default_schema), typed)
+            self.assertEqual(self.read(2, cache=cache), generic)
+
+
+class QueryTest(unittest.TestCase):
+    """DatQuery over a columnar parser gives what it does over dicts. In
+    ITEMS.DAT only some headers have attack, so its column is shorter
+    than the store."""
+
+    def setUp(self):
+        paths = [os.path.join(DATA, name)
+            for name in ('ITEMS.DAT', 'ACTORS.DAT')]
+        self.parsers = [DatParser(cache=False, columnar=columnar)
+            for columnar in (False, True)]
+        for parser in self.parsers:
+            parser.read(*paths)
+
+    def assertSame(self, run):
+        plain, columnar = [run(parser.query()) for parser in self.parsers]
+        self.assertEqual(plain, columnar)
+        return columnar
+
+    def _queries(self):
+        items = lambda query: query.where('type', '==', 'item')
+        self.assertEqual(self.assertSame(
+            lambda query: items(query).sortBy('attack').getHeaders())[0],
+            'template equipment')
+        self.assertSame(
+            lambda query: items(query).sortBy('weight', True).getHeaders())
+        self.assertEqual(self.assertSame(
+            lambda query: query.where('attack', '>', 10).getHeaders()),
+            ['template equipment'])
+        self.assertSame(lambda query: query.where('health', '<=', 100)
+            .getHeaders())
+        self.assertEqual(self.assertSame(
+            lambda query: items(query).groupBy('subtype', 'attack', 'max')),
+            {'consumable': None, 'equipment': 3000, 'key': None})
+        self.assertSame(lambda query: query.groupBy('type', 'health', 'mean'))
+        self.assertSame(lambda query: [value == value
+            for value in query.array('defense').tolist()])
+
+    @unittest.skipIf(datparser.numpy is None, 'needs numpy')
+    def test_numpy(self):
+        self._queries()
+
+    def test_without_numpy(self):
+        with mock.patch.object(datparser, 'numpy', None):
+            self._queries()
+
+
+if __name__ == '__main__':
+    unittest.main()
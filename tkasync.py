@@ -0,0 +1,107 @@
+"""Runs Tk from an asyncio event loop.
+
+Instead of each widget keeping its own after() timers and Tk's mainloop()
+owning the thread, Tk events are handled from a coroutine, so game logic,
+DatParser loads and saves, and the UI can all be written as coroutines
+sharing one loop:
+
+    async def game(console):
+        while True:
+            path = await console.readInput()
+            parser = DatParser()
+            await tkasync.inThread(parser.read, path)
+            console.addOutput(parser.getNames())
+
+    tkasync.run(root, game(console))
+
+Only hand inThread() work that touches neither Tk nor shared state, like
+parsing into a parser of its own. Tk may only be used from the loop's
+thread, and DatRegistry isn't thread-safe either: get() can notify widgets
+of a changed file. Registry calls stay on the loop thread.
+
+Timers set with after() are Tk events like any other, so widgets written
+for mainloop(), like the editor's polling and dragging loops, keep working
+unchanged under run(). every() and spawn() are for new code that wants its
+loops as tasks.
+"""
+
+import _tkinter
+import asyncio
+import tkinter as tk
+
+
+class TkLoop(object):
+    """Handles the events of a Tk root every interval seconds from the
+    running asyncio loop, until the root's window is closed. Tasks started
+    with spawn() are cancelled when it is."""
+
+    def __init__(self, root, interval=0.01):
+        self.root = root
+        self.interval = interval
+        self.tasks = set()
+        self.closed = False
+        root.protocol('WM_DELETE_WINDOW', self.close)
+
+    def close(self):
+        self.closed = True
+
+    def spawn(self, coro):
+        """Run coro as a task living as long as the root."""
+        task = asyncio.ensure_future(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    def every(self, seconds, func, *args):
+        """Call func(*args) every seconds until it returns False, as a
+        task, in place of an after() loop rescheduling itself."""
+        return self.spawn(every(seconds, func, *args))
+
+    def update(self):
+        # Everything Tk has waiting, without blocking
+        try:
+            while self.root.tk.dooneevent(_tkinter.DONT_WAIT):
+                pass
+        except tk.TclError:
+            # The root was destroyed some other way
+            self.closed = True
+
+    async def run(self):
+        try:
+            while not self.closed:
+                self.update()
+                await asyncio.sleep(self.interval)
+        finally:
+            for task in list(self.tasks):
+                task.cancel()
+            try:
+                self.root.destroy()
+            except tk.TclError:
+                pass
+
+
+async def every(seconds, func, *args):
+    """Call func(*args) every seconds until it returns False."""
+    while func(*args) is not False:
+        await asyncio.sleep(seconds)
+
+
+async def inThread(func, *args):
+    """Run a blocking call, like DatParser.read or save, in a worker
+    thread, so the UI keeps being updated meanwhile. func must not use Tk
+    or the DatRegistry."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, func, *args)
+
+
+def run(root, *coros, interval=0.01):
+    """Drive root from a new asyncio loop, running coros alongside it,
+    until its window is closed. Takes the place of root.mainloop()."""
+
+    async def main():
+        tkloop = TkLoop(root, interval)
+        for coro in coros:
+            tkloop.spawn(coro)
+        await tkloop.run()
+
+    asyncio.run(main())
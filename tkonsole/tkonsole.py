@@ -1,4 +1,7 @@
+import asyncio
+import time
 import tkinter as tk
+from collections import deque
 from inspect import signature
 
 
@@ -7,10 +10,13 @@ class TKonsole(tk.Frame):
 		cwidth = kw.pop('cwidth', 50)
 		cheight = kw.pop('cheight', 10)
 		cbc = kw.pop('cbc', False)
+		# Passed on to the OutputBox, see there
+		scrollback = dict((key, kw.pop(key)) for key in 
+			('maxlines', 'maxchars', 'spill') if key in kw)
 
 		tk.Frame.__init__(self, master, cnf, **kw)
 
-		self.obox = OutputBox(self, cbc=cbc)
+		self.obox = OutputBox(self, cbc=cbc, **scrollback)
 		self.obox.config(
 			border=0,
 			width=cwidth,
@@ -44,9 +50,28 @@ class TKonsole(tk.Frame):
 		# Optional 'click' input method
 		self.prompt.bind('<Button-1>', self.ibox.addInput)
 		
+		# Typing skips whatever is still being typed out
+		if cbc:
+			self.ibox.bind('<Key>', self.obox.skip, add='+')
+		
 	def getInput(self):
 		return self.ibox.getInput()
 		
+	def waitInput(self):
+		return self.ibox.waitInput()
+		
+	async def readInput(self):
+		return await self.ibox.readInput()
+		
+	async def drain(self):
+		await self.obox.drain()
+		
+	def onInput(self, callback):
+		return self.ibox.onInput(callback)
+		
+	def offInput(self, callback):
+		self.ibox.offInput(callback)
+		
 	def isCommand(self, s):
 		splt = s.split()
 		if not isinstance(splt, list):
@@ -63,6 +88,11 @@ class TKonsole(tk.Frame):
 		
 		
 class InputBox(tk.Entry):
+	"""An Entry taking lines of input. Each line entered goes to the
+	longest waiting readInput(), otherwise to every callback given to
+	onInput(), otherwise onto the queue read by getInput() and waitInput().
+	<<InputReady>> is generated on the box for each line either way."""
+	
 	def __init__(self, master=None, cnf={}, **kw):
 		self.obox = kw.pop('obox', None)
 		
@@ -71,7 +101,11 @@ class InputBox(tk.Entry):
 		self.bind('<Up>', self.histUp)
 		self.bind('<Down>', self.histDown)
 			
-		self.queue = []
+		self.queue = deque()
+		self.callbacks = []
+		self.waiters = deque()
+		# Counts lines queued, for waitInput to wait on
+		self.queued = tk.IntVar(self, 0)
 		self.curinput = False
 		self.history = []
 		self.history_index = 0
@@ -107,65 +141,213 @@ class InputBox(tk.Entry):
 		
 		self.history.append(line)
 		self.history_index = len(self.history)
-		self.queue.append(line.strip())
 		if self.obox is not None:
 			self.obox.addOutput('>> ' + line)
 		self.set('')
+		self.deliver(line.strip())
+		self.event_generate('<<InputReady>>', when='tail')
+		
+	def deliver(self, line):
+		while len(self.waiters) != 0:
+			waiter = self.waiters.popleft()
+			if not waiter.done():
+				waiter.set_result(line)
+				return
+		if len(self.callbacks) != 0:
+			for callback in list(self.callbacks):
+				callback(line)
+			return
+		self.queue.append(line)
+		self.queued.set(self.queued.get() + 1)
 		
 	def getInput(self):
+		"""The oldest queued line, or False when there is none."""
 		try:
-			return self.queue.pop(0)
-		except:
+			return self.queue.popleft()
+		except IndexError:
 			return False
+			
+	def waitInput(self):
+		"""The oldest queued line, waiting for one if needed. Tk events are
+		handled meanwhile, without using any CPU while idle."""
+		while len(self.queue) == 0:
+			self.wait_variable(self.queued)
+		return self.queue.popleft()
+		
+	async def readInput(self):
+		"""The next line, awaited from an asyncio coroutine. Tk has to be
+		kept updated while waiting."""
+		if len(self.queue) != 0:
+			return self.queue.popleft()
+		waiter = asyncio.get_running_loop().create_future()
+		self.waiters.append(waiter)
+		return await waiter
+		
+	def onInput(self, callback):
+		"""Call callback(line) for every line entered from now on, instead
+		of queueing them."""
+		self.callbacks.append(callback)
+		return callback
+		
+	def offInput(self, callback):
+		if callback in self.callbacks:
+			self.callbacks.remove(callback)
 
 			
 class OutputBox(tk.Text):
+	"""A read-only Text that shows queued lines. Every frame ms, all the
+	lines queued since the last frame are drawn at once, or only the first
+	budget of them when budget is given. Nothing is scheduled while the
+	queue is empty. With cbc, lines are typed out at cps characters a
+	second instead, catching up when frames run late. skip() shows the
+	rest at once, and is called for any key pressed while the box, or
+	the input of its TKonsole, has focus.
+	
+	maxlines and maxchars bound the scrollback. Once either is passed by
+	a tenth, the oldest lines are trimmed back to it, and appended to the
+	file spill when one is given."""
+	
 	def __init__(self, master=None, cnf={}, **kw):
 		self.cbc = kw.pop('cbc', False)
+		self.frame = kw.pop('frame', 25)
+		self.budget = kw.pop('budget', None)
+		self.cps = kw.pop('cps', 140)
+		self.maxlines = kw.pop('maxlines', None)
+		self.maxchars = kw.pop('maxchars', None)
+		self.spill = kw.pop('spill', None)
+		# What has been written so far, for trimming
+		self.lines = 0
+		self.chars = 0
 		tk.Text.__init__(self, master, cnf, **kw)
 		self.config(state=tk.DISABLED, cursor='arrow', wrap='char', 
         background='black',
         foreground='#7fff51',
         font='monaco 9')
-		self.queue = []
+		self.queue = deque()
+		self.stop_id = None
 		
+		# Typed text is inserted at once, hidden, and uncovered up to the
+		# 'typed' mark as time passes
+		self.tag_config('untyped', elide=True)
+		self.mark_set('typed', 'end -1c')
+		self.mark_gravity('typed', tk.LEFT)
+		self.typed_at = None
+		self.typed_carry = 0.0
 		if self.cbc:
-			self.cbcOutput()
-		else:
-			self.output()
+			self.bind('<Key>', self.skip)
 		
 	def addOutput(self, s):
 		s = str(s)
 		self.queue.append(s+'\n')
+		if self.stop_id is None:
+			if self.cbc:
+				self.typed_at = time.monotonic()
+				self.stop_id = self.after(self.frame, self.cbcOutput)
+			else:
+				self.stop_id = self.after(self.frame, self.output)
 		
 	def output(self):
+		self.stop_id = None
+		if len(self.queue) == 0:
+			return
+		
+		if self.budget is None or len(self.queue) <= self.budget:
+			text = ''.join(self.queue)
+			self.queue.clear()
+		else:
+			text = ''.join([self.queue.popleft() for i in range(self.budget)])
+		self.write(text)
+		self.see('end')
+		
 		if len(self.queue) != 0:
-			self.config(state=tk.NORMAL)
-			self.insert(tk.END, self.queue.pop(0))
-			self.config(state=tk.DISABLED)
-			self.see('end')
-			
-		self.stop_id = self.after(25, self.output)
+			self.stop_id = self.after(self.frame, self.output)
+	
+	def write(self, text, tags=None):
+		"""Add text to the end straight away, trimming the scrollback."""
+		self.config(state=tk.NORMAL)
+		self.insert(tk.END, text, tags)
+		self.lines += text.count('\n')
+		self.chars += len(text)
+		self.trim()
+		self.config(state=tk.DISABLED)
+		
+	def _over(self, count, limit):
+		return limit is not None and count > limit + max(1, limit // 10)
+		
+	def trim(self):
+		end = None
+		if self._over(self.lines, self.maxlines):
+			end = '%d.0' % (self.lines - self.maxlines + 1)
+		if self._over(self.chars, self.maxchars):
+			index = self.index('1.0 + %d chars' % (self.chars - self.maxchars))
+			if not index.endswith('.0'):
+				index = self.index(index + ' +1 lines linestart')
+			if end is None or self.compare(index, '>', end):
+				end = index
+		if end is None:
+			return
+		
+		state = self.cget('state')
+		self.config(state=tk.NORMAL)
+		text = self.get('1.0', end)
+		self.delete('1.0', end)
+		self.config(state=state)
+		self.lines -= text.count('\n')
+		self.chars -= len(text)
+		if self.spill is not None:
+			try:
+				with open(self.spill, 'a', encoding='utf-8') as f:
+					f.write(text)
+			except OSError:
+				# Keep going without the history rather than fail output
+				self.spill = None
+	
+	def destroy(self):
+		if self.stop_id is not None:
+			self.after_cancel(self.stop_id)
+			self.stop_id = None
+		tk.Text.destroy(self)
 	
 	def cbcOutput(self):
-		# Output a line char by char
+		# Type out as many characters as the time since the last frame
+		# allows, all in one go
+		self.stop_id = None
 		if len(self.queue) != 0:
-			self.see('end') #<- Do first; if last, moves down after line 
-							# finished. This should be less awkward.
-			line = self.queue[0]
-			char = line[0]
-			self.config(state=tk.NORMAL)
-			self.insert(tk.END, char)
-			self.config(state=tk.DISABLED)
-			newline = line[1:len(line)]
-			self.queue[0] = newline
-		
-			if len(self.queue[0]) == 0:
-				self.config(state=tk.NORMAL)
-				self.config(state=tk.DISABLED)
-				self.queue.pop(0)
+			self.write(''.join(self.queue), 'untyped')
+			self.queue.clear()
+		
+		now = time.monotonic()
+		if self.typed_at is None:
+			self.typed_at = now
+		due = (now - self.typed_at) * self.cps + self.typed_carry
+		self.typed_at = now
+		count = int(due)
+		self.typed_carry = due - count
+		if count != 0:
+			self.mark_set('typed', 'typed + %d any chars' % count)
+			self.tag_remove('untyped', '1.0', 'typed')
+			self.see('typed')
+		
+		if self.compare('typed', '<', 'end -1c'):
+			self.stop_id = self.after(self.frame, self.cbcOutput)
+		else:
+			self.typed_at = None
+			self.typed_carry = 0.0
 			
-		self.stop_id = self.after(7, self.cbcOutput)
+	def skip(self, event=None):
+		"""Show everything still being typed out."""
+		if len(self.queue) != 0:
+			self.write(''.join(self.queue))
+			self.queue.clear()
+		self.mark_set('typed', 'end -1c')
+		self.tag_remove('untyped', '1.0', 'end')
+		self.see('end')
+		
+	async def drain(self):
+		"""Wait until everything queued so far has been shown, and typed
+		out in cbc mode, from an asyncio coroutine (see tkasync)."""
+		while self.stop_id is not None:
+			await asyncio.sleep(self.frame / 1000)
 		
 		
 def main():
@@ -200,17 +382,15 @@ def main():
 	split2 = tk.Frame(root, height=5, bg='green')
 	split2.grid(column=0, row=1, columnspan=3, stick=tk.W + tk.E)
 	
-	while True:
-		root.update()
-			
-		a = con1.getInput()
-		b = con2.getInput()
-		if a:
-			con1.output(a)
-			out1.output('> ' + a)
-		if b:
-			con2.output(b)
-			out1.output('> ' + b) 
+	def echo(con):
+		def onLine(line):
+			con.addOutput(line)
+			out1.addOutput('> ' + line)
+		return onLine
+	
+	con1.onInput(echo(con1))
+	con2.onInput(echo(con2))
+	root.mainloop()
 		
 if __name__ == '__main__':
 	main()
\ No newline at end of file